@@ -225,8 +225,16 @@ class UpdaterPage(QWidget):
         self.rename_button = QPushButton('Rename')
         self.rename_button.clicked.connect(self.rename)
         
+        self.jobs_widget = QSpinBox()
+        self.jobs_widget.setRange(1, os.cpu_count() or 1)
+        self.jobs_widget.setValue(os.cpu_count() or 1)
+        self.jobs_layout = QHBoxLayout()
+        self.jobs_layout.addWidget(QLabel('Workers:'))
+        self.jobs_layout.addWidget(self.jobs_widget)
+        
         self.update_layout = QVBoxLayout()
         self.update_layout.addWidget(self.how_to_label)
+        self.update_layout.addLayout(self.jobs_layout)
         self.update_layout.addWidget(self.update_button)
         self.update_layout.addWidget(self.rename_button)
         
@@ -273,27 +281,14 @@ class UpdaterPage(QWidget):
                 msg.setText('Vanilla OL.seria file is missing. Sensor/EWAR stats will not be updated.')
                 msg.exec_()
             
-            for idx in range(self.target_list.count()):
-                item = self.target_list.item(idx).text()
-                self.app_state.log(f'Updating {item}')
-                path = os.path.join(self.source_path, item)
-                out_path = os.path.join(self.target_path, item)
-                
-                ship = Ship.from_file(path, self.app_state)
-                
-                try:
-                    ship.recompute_stats(OL_lib, vanilla_OL_lib, parts_lib, logger=self.app_state, verbose=True)
-                    ship.write(out_path, logger=self.app_state)
-                except:
-                    try:
-                        self.app_state.log('Cannot update global stats, recomputing local only.')
-                        ship = Ship.from_file(path, logger=self.app_state)
-                        ship.update_modules(parts_lib, OL_lib, vanilla_OL_lib)
-                        ship.write(out_path, logger=self.app_state)
-                    except:
-                        self.app_state.log('Cannot update')
-                        self.app_state.log('---------------------------')
-                self.app_state.log('')
+            items = [ self.target_list.item(idx).text() for idx in range(self.target_list.count()) ]
+            paths = [ os.path.join(self.source_path, item) for item in items ]
+            out_paths = [ os.path.join(self.target_path, item) for item in items ]
+            
+            for lines in update_ships(paths, out_paths, OL_lib, vanilla_OL_lib, parts_lib, self.jobs_widget.value()):
+                for line in lines:
+                    self.app_state.log(line)
+                QApplication.processEvents()
         else:
             pass
                 
@@ -528,7 +523,7 @@ class MapWidget(QWidget):
                     AG = False
                     MG = False
                     
-                    stats = [ ship.find_by_attr('m_code', 47)[0] for ship in escadra.get_children_by_name('m_children') ]
+                    stats = [ ship.query('m_code', 47)[0] for ship in escadra.get_children_by_name('m_children') ]
                     
                     for stat in stats:
                         if getattr(stat, 'm_tele_crafts', 0) > 0: AG = True
@@ -687,16 +682,17 @@ class NewEscadraDialog(QDialog):
             vanilla_path = os.path.join(os.path.join(self.app_state.root, 'Objects/Designs'), ship)
             ships_path = os.path.join(os.path.join(self.app_state.root, 'Ships'), ship)
                 
+            #Only the frame, its meshes and the bridge get parsed for a compacted repr, other parts are skipped by their name
             if os.path.exists(vanilla_path):
-                ship = Ship.from_file(vanilla_path)
+                ship = Ship.lazy_from_file(vanilla_path, self.app_state)
             elif os.path.exists(ships_path):
-                ship = Ship.from_file(ships_path)
+                ship = Ship.lazy_from_file(ships_path, self.app_state)
             else:
                 raise FileNotFoundError(f'Cannot find ship file {ship} in Objects/Designs or Ships folders.')
             
             ship = get_compacted_ship_repr(ship, escadra.m_id, i + 1)
         
-            escadra.output_order.append((('m_children', 7), ship))
+            escadra.add_child(('m_children', 7), ship)
         
         #Define escadra type and initial behavior
         escadra.set('m_position.x', float(self.m_position_x_widget.text()))
@@ -712,7 +708,7 @@ class NewEscadraDialog(QDialog):
         inventory.set('m_code', 7)
         inventory.set('m_id', generate_id())
         
-        escadra.output_order.append((('m_inventory', 7), inventory))
+        escadra.add_child(('m_inventory', 7), inventory)
         
         #Make an intel node so an escadra will have a name on a map
         intel = Node()
@@ -731,7 +727,7 @@ class NewEscadraDialog(QDialog):
         intel.set('m_rad_encrypted', 'true')
         intel.set('m_size', 2)
         
-        escadra.output_order.append((('m_intels', 515), intel))
+        escadra.add_child(('m_intels', 515), intel)
         
         return escadra
         
@@ -896,17 +892,18 @@ class EditEscadraDialog(QDialog):
             ship = self.menu_chosen.item(i)
             if hasattr(ship, 'ship'):
                 ship = ship.ship
-                ship[1].find_by_attr('m_code', 47)[0].set('m_escadra_index', i + 1)
+                ship[1].query('m_code', 47)[0].set('m_escadra_index', i + 1)
                 ships.append(ship)
             else:
                 ship = ship.text()
                 vanilla_path = os.path.join(os.path.join(self.app_state.root, 'Objects/Designs'), ship)
                 ships_path = os.path.join(os.path.join(self.app_state.root, 'Ships'), ship)
                     
+                #Only the frame, its meshes and the bridge get parsed for a compacted repr, other parts are skipped by their name
                 if os.path.exists(vanilla_path):
-                    ship = Ship.from_file(vanilla_path)
+                    ship = Ship.lazy_from_file(vanilla_path, self.app_state)
                 elif os.path.exists(ships_path):
-                    ship = Ship.from_file(ships_path)
+                    ship = Ship.lazy_from_file(ships_path, self.app_state)
                 else:
                     raise FileNotFoundError(f'Cannot find ship file {ship} in Objects/Designs or Ships folders.')
                 
@@ -914,7 +911,7 @@ class EditEscadraDialog(QDialog):
             
                 ships.append((('m_children', 7), ship))
         
-        [ escadra.output_order.append(ship) for ship in ships ]
+        [ escadra.add_child(*ship) for ship in ships ]
                 
         #Define escadra type and initial behavior
         escadra.set('m_position.x', float(self.m_position_x_widget.text()))
@@ -989,11 +986,16 @@ class MapViewerPage(QWidget):
     def open_save(self):
         try:
             path, _ = QFileDialog.getOpenFileName(self, 'Open save', os.path.join(self.app_state.root, 'Saves'))
-            save = Node.from_file(path)
+            #Only the map objects are parsed when displayed, the rest of the save is copied verbatim on export. The
+            #file is read into memory rather than mapped, so the game can still overwrite it while the save is open
+            save = Node.lazy_from_file(path, self.app_state, mapped=False)
+            if save is None: raise ValueError('Cannot parse the save')
         except:
             self.app_state.log('Cannot open save:')
             self.app_state.log(path)
             return
+        id_allocator.reserve_tree(save) #New escadras never reuse IDs of the map objects
+        self.save_path = path
         self.save_path_field.setText(path)
         self.map_widget.set_save(save)
     
@@ -1011,7 +1013,7 @@ class MapViewerPage(QWidget):
             role = 'Garrison'            
             AG = False
             MG = False
-            stats = [ ship.find_by_attr('m_code', 47)[0] for ship in escadra.get_children_by_name('m_children') ]
+            stats = [ ship.query('m_code', 47)[0] for ship in escadra.get_children_by_name('m_children') ]
                     
             for stat in stats:
                 if getattr(stat, 'm_tele_crafts', 0) > 0:
@@ -1083,12 +1085,12 @@ class MapViewerPage(QWidget):
             pass
            
     def export_save(self):
-        save = self.map_widget.save
-        if save is None:
+        if self.save_path is None or self.map_widget.save is None:
             return
         output_path, _ = QFileDialog.getSaveFileName(self, 'Export Save', self.app_state.root)
         if output_path is None or not output_path:
             return
+        save = self.map_widget.save
         escadras = self.map_widget.escadras
         
         first_escadra_index = 0
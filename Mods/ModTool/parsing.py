@@ -1,11 +1,105 @@
 from utils import *
 
+class NodeShape(object):
+  '''Attribute names and the output layout of a node. Nodes with the same attributes in the same order share one
+  shape, so a node itself keeps only a list of values. order holds the indices of the output attributes and -1 for
+  each child, attributes set but not in order aren't output. Shapes are immutable, a change gives another shape.'''
+  __slots__ = ('names', 'order', 'index', 'visible', 'transitions')
+  shapes = {} #(names, order) -> shape
+
+  def __init__(self, names, order):
+    self.names = names
+    self.order = order
+    self.index = { name: i for i, name in enumerate(names) }
+    self.visible = frozenset([ names[i] for i in order if i >= 0 ])
+    self.transitions = {} #Cached results of with_attr/with_child, the same few of them are used while parsing
+
+  def __reduce__(self):
+    return (NodeShape.get, (self.names, self.order))
+
+  @staticmethod
+  def get(names, order):
+    shape = NodeShape.shapes.get((names, order))
+    if shape is None:
+      shape = NodeShape.shapes[(names, order)] = NodeShape(names, order)
+    return shape
+
+  def with_attr(self, attr, visible=True):
+    '''Returns the shape with a new attribute appended to the names and, if visible, to the output'''
+    key = attr if visible else ('hidden', attr)
+    shape = self.transitions.get(key)
+    if shape is None:
+      order = self.order + (len(self.names),) if visible else self.order
+      shape = self.transitions[key] = NodeShape.get(self.names + (intern_name(attr),), order)
+    return shape
+
+  def with_child(self):
+    shape = self.transitions.get(None)
+    if shape is None:
+      shape = self.transitions[None] = NodeShape.get(self.names, self.order + (-1,))
+    return shape
+
+NodeShape.empty = NodeShape.get((), ())
+
 class Node(object):
   '''General class to work with recursively nested HF config objects. Implements parsing from text,
   short (for general displaying) and full (for *.seria outputting) text representations and functions to look up
-  nodes by their attributes.'''
+  nodes by their attributes. Attributes are kept in a values list described by a shared NodeShape and are read
+  and written as usual Python attributes, children are ((name, id), node) pairs in the file order.'''
+  __slots__ = ('shape', 'values', 'children', 'lazy_block', 'query_index', 'indexed_by')
+  direct_attrs = frozenset(__slots__ + ('output_order',)) #Not stored in the attribute table
+  encoding = "cp1251"
+
   def __init__(self):
-    self.output_order = []
+    self.shape = NodeShape.empty
+    self.values = []
+    self.children = () #Replaced by a list on the first child
+    self.indexed_by = () #Query indices of the trees this node is in, see get_query_index
+
+  def __getattr__(self, attr):
+    if attr in Node.direct_attrs or attr.startswith('__'): raise AttributeError(attr)
+    i = self.shape.index.get(attr)
+    if i is None: raise AttributeError(attr)
+    return self.values[i]
+
+  def __setattr__(self, attr, value):
+    if attr in Node.direct_attrs or attr.startswith('__'): return object.__setattr__(self, attr, value)
+    for index in self.indexed_by: index.pop(attr, None)
+    i = self.shape.index.get(attr)
+    if i is None: #A new attribute isn't output until it's added through set
+      self.shape = self.shape.with_attr(attr, visible=False)
+      self.values.append(value)
+    else:
+      self.values[i] = value
+
+  def __getstate__(self):
+    return (self.shape, self.values, self.children)
+
+  def __setstate__(self, state):
+    self.shape, self.values, self.children = state
+    self.indexed_by = ()
+
+  @property
+  def output_order(self):
+    '''Attribute names, 'num_seq' and ((name, id), node) children in the output order. The list is built on access,
+    so assign a changed list back instead of editing it in place, or use add_child/set/remove.'''
+    names, children = self.shape.names, iter(self.children)
+    return [ names[i] if i >= 0 else next(children) for i in self.shape.order ]
+
+  @output_order.setter
+  def output_order(self, items):
+    order, children = [], []
+    for item in items:
+      if isinstance(item, tuple):
+        order.append(-1)
+        children.append(item)
+      else:
+        i = self.shape.index.get(item)
+        if i is None: raise AttributeError(item)
+        order.append(i)
+    self.children = children
+    self.shape = NodeShape.get(self.shape.names, tuple(order))
+    for index in self.indexed_by: index.clear()
 
   def __repr__(self):
     return str(self)
@@ -30,65 +124,484 @@ class Node(object):
     output_buff += '}'
     return output_buff
 
-  def output(self, logger=Logger()):
-    output_buff = '{\n'
-    for item in self.output_order:
-      if item == 'num_seq':
-        for x in self.num_seq: output_buff += str(x) + '\n'
-      elif isinstance(item, str):
-        attr = item
-        val  = getattr(self, attr)
-        
-        if not isinstance(val, list): output_buff += attr + '=' + str(val) + '\n'
+  def iter_output(self, raw=False):
+    '''Yields the full *.seria text representation in chunks, e.g. to stream it into a file. Nested nodes are
+    walked with an explicit stack instead of concatenating each child's full output. With raw=True untouched lazy
+    blocks are yielded as their undecoded bytes.'''
+    stack = [ (self, iter(self.shape.order), iter(self.children)) ]
+    yield '{\n'
+    while stack:
+      node, order, children = stack[-1]
+      names, values = node.shape.names, node.values
+      for i in order:
+        if i >= 0:
+          item, val = names[i], values[i]
+          if item == 'num_seq':
+            yield ''.join([ str(x) + '\n' for x in val ])
+          elif not isinstance(val, list): yield item + '=' + str(val) + '\n'
+          else:
+            yield ''.join([ item + '=' + str(x) + '\n' for x in val ])
         else:
-          for x in val:
-            output_buff += attr + '=' + str(x) + '\n'
-      elif isinstance(item, tuple):
-        header, node = item
-        output_buff += str(header[0]) + '=' + str(header[1]) + '\n'
-        output_buff += node.output()
+          header, child = next(children)
+          yield str(header[0]) + '=' + str(header[1]) + '\n{\n'
+          if isinstance(child, LazyNode): #Never touched, so unchanged
+            yield child.raw() if raw else child.text()
+            yield '}\n'
+            continue
+          stack.append((child, iter(child.shape.order), iter(child.children)))
+          break
       else:
-        logger.log('Cannot parse item:', item)
-        return None
-    output_buff += '}\n'
-    return output_buff
+        stack.pop()
+        yield '}\n'
+
+  def output(self, logger=Logger()):
+    try:
+      return ''.join(self.iter_output())
+    except UnicodeDecodeError as e: #An untouched lazy block out of the file encoding
+      logger.log('Cannot decode a lazy block:', e)
+      return None
 
   def write(self, path, logger=Logger()):
-    with open(path, 'w', encoding="cp1251") as f:
-      f.write(self.output(logger))
+    #Lazy subtrees may be read from the file being overwritten, so the output replaces it only when complete
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+      with open(tmp_path, 'wb') as f:
+        if path.endswith(SERIAB_EXTENSION):
+          f.write(self.to_binary())
+        else:
+          for chunk in self.iter_output(raw=True):
+            if isinstance(chunk, str):
+              if os.linesep != '\n': chunk = chunk.replace('\n', os.linesep) #As the text mode would do
+              chunk = chunk.encode(self.encoding)
+            elif b'\r' in chunk or os.linesep != '\n': #Untouched blocks get the line ends of the rest, as LazySource.text does
+              chunk = chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+              if os.linesep != '\n': chunk = chunk.replace(b'\n', os.linesep.encode())
+            f.write(chunk)
+      try:
+        os.replace(tmp_path, path)
+      except PermissionError: #Windows does not replace memory-mapped files
+        LazySource.release_all(path)
+        os.replace(tmp_path, path)
+    except:
+      if os.path.exists(tmp_path): os.remove(tmp_path)
+      raise
+
+  def to_binary(self):
+    '''Encodes the tree into the .seriab format, lossless against output. Output layouts of nodes, the value kinds
+    and strings are kept once in tables, so a node takes two table indices, its packed values and its children.'''
+    strings, layouts, formats = {}, {}, {}
+    
+    def string_index(string):
+      i = strings.get(string)
+      if i is None: i = strings[string] = len(strings)
+      return i
+    
+    simple_kinds = { str: 's', float: 'd', int: 'q' }
+    
+    def pack_values(values, nested=False, exact=False):
+      '''Returns the format index and the packed bytes of values. Items of lists are scalars, so nested sequences
+      are kept as text. Ints are taken for int64 unless exact is set, the packing fails on the rare longer ones.'''
+      if exact: kinds = ''.join([ seriab_kind(value) for value in values ])
+      else: kinds = ''.join([ simple_kinds.get(type(value)) or seriab_kind(value) for value in values ])
+      if nested and ('n' in kinds or 'l' in kinds): kinds = kinds.replace('n', 'x').replace('l', 'x')
+      if kinds not in formats:
+        formats[kinds] = (len(formats), struct.Struct('<' + ''.join([ SERIAB_CODES[kind] for kind in kinds ])))
+      format_index, fmt = formats[kinds]
+      
+      try:
+        if kinds.strip('qds'): #Arrays, lists and other values, their data follows the fixed size part
+          packed, tail = [], []
+          for kind, value in zip(kinds, values):
+            if kind == 's': packed.append(string_index(value))
+            elif kind == 'q' or kind == 'd': packed.append(value)
+            elif kind == 'n':
+              packed.append(len(value))
+              tail.append(float_array_bytes(value))
+            elif kind == 'l':
+              item_format, item_bytes = pack_values(value, True)
+              packed.append(item_format)
+              tail.append(item_bytes)
+            else:
+              packed.append(string_index(str(value)))
+          packed = fmt.pack(*packed) + b''.join(tail)
+        else:
+          packed = [ string_index(value) if kind == 's' else value for kind, value in zip(kinds, values) ]
+          packed = fmt.pack(*packed)
+      except struct.error: #An int out of the int64 range
+        if exact: raise
+        return pack_values(values, nested, exact=True)
+      return format_index, packed
+    
+    body = bytearray()
+    shape_layouts = {} #Node shape -> (layout index, indices of the output values)
+    stack = [ (None, self) ] #Nodes are written in the pre-order, each followed by its children
+    while stack:
+      header, node = stack.pop()
+      if header is not None:
+        format_index, packed = pack_values(header[1:], True)
+        body += SERIAB_PAIR.pack(string_index(header[0]), format_index) + packed
+      
+      shape = node.shape
+      if shape not in shape_layouts:
+        layout = tuple([ string_index(shape.names[i]) if i >= 0 else -1 for i in shape.order ])
+        shape_layouts[shape] = (layouts.setdefault(layout, len(layouts)), [ i for i in shape.order if i >= 0 ])
+      layout_index, value_indices = shape_layouts[shape]
+      
+      values = node.values
+      format_index, packed = pack_values([ values[i] for i in value_indices ])
+      body += SERIAB_PAIR.pack(layout_index, format_index) + packed
+      stack.extend(reversed(node.children))
+    
+    data = bytearray(SERIAB_MAGIC)
+    data += struct.pack('<III', len(strings), len(layouts), len(formats))
+    for string in strings:
+      encoded = string.encode('utf-8')
+      data += SERIAB_UINT.pack(len(encoded)) + encoded
+    for layout in layouts:
+      data += SERIAB_UINT.pack(len(layout)) + struct.pack(f'<{len(layout)}i', *layout)
+    for kinds in formats:
+      data += SERIAB_UINT.pack(len(kinds)) + kinds.encode('ascii')
+    return bytes(data + body)
+
+  @classmethod
+  def from_binary(cls, data):
+    '''Decodes a tree from the to_binary output, all nodes get this class. Raises ValueError on broken data.'''
+    if data[:len(SERIAB_MAGIC)] != SERIAB_MAGIC: raise ValueError('Not a .seriab file or an unknown version')
+    
+    try:
+      pos = len(SERIAB_MAGIC)
+      string_count, layout_count, format_count = struct.unpack_from('<III', data, pos)
+      pos += 12
+      
+      strings = []
+      for i in range(string_count):
+        (size,) = SERIAB_UINT.unpack_from(data, pos)
+        strings.append(intern_value(bytes(data[pos + 4:pos + 4 + size]).decode('utf-8')))
+        pos += 4 + size
+      
+      shapes = [] #(shape, number of children) pairs
+      for i in range(layout_count):
+        (size,) = SERIAB_UINT.unpack_from(data, pos)
+        layout = struct.unpack_from(f'<{size}i', data, pos + 4)
+        pos += 4 + 4 * size
+        
+        names = tuple([ intern_name(strings[item]) for item in layout if item >= 0 ])
+        order, attr_count = [], 0
+        for item in layout:
+          order.append(attr_count if item >= 0 else -1)
+          if item >= 0: attr_count += 1
+        shapes.append((NodeShape.get(names, tuple(order)), layout.count(-1)))
+      
+      formats = [] #(struct, kinds, only numbers) triples
+      for i in range(format_count):
+        (size,) = SERIAB_UINT.unpack_from(data, pos)
+        kinds = bytes(data[pos + 4:pos + 4 + size]).decode('ascii')
+        pos += 4 + size
+        formats.append((struct.Struct('<' + ''.join([ SERIAB_CODES[kind] for kind in kinds ])), kinds, set(kinds) <= set('qd')))
+      
+      def read_values(format_index, pos):
+        fmt, kinds, only_numbers = formats[format_index]
+        values = list(fmt.unpack_from(data, pos))
+        pos += fmt.size
+        if only_numbers: return values, pos
+        
+        for i, kind in enumerate(kinds):
+          if kind == 's' or kind == 'x': values[i] = strings[values[i]]
+          elif kind == 'b': values[i] = int(strings[values[i]])
+          elif kind == 'n':
+            values[i], pos = float_array_from_bytes(data[pos:pos + 8 * values[i]]), pos + 8 * values[i]
+          elif kind == 'l':
+            values[i], pos = read_values(values[i], pos)
+        return values, pos
+      
+      #Nodes are filled through the slot descriptors, a save has hundreds of thousands of them
+      set_shape, set_values, set_children = Node.shape.__set__, Node.values.__set__, Node.children.__set__
+      set_indexed_by = Node.indexed_by.__set__
+      
+      def read_node(pos):
+        layout_index, format_index = SERIAB_PAIR.unpack_from(data, pos)
+        shape, child_count = shapes[layout_index]
+        values, pos = read_values(format_index, pos + SERIAB_PAIR.size)
+        
+        node = cls.__new__(cls)
+        set_shape(node, shape)
+        set_values(node, values)
+        set_children(node, [] if child_count else ())
+        set_indexed_by(node, ())
+        return node, child_count, pos
+      
+      root, child_count, pos = read_node(pos)
+      stack = [ [root, child_count] ] #Nodes with the number of children left to read
+      while stack:
+        if not stack[-1][1]:
+          stack.pop()
+          continue
+        stack[-1][1] -= 1
+        
+        name, format_index = SERIAB_PAIR.unpack_from(data, pos)
+        value, pos = read_values(format_index, pos + SERIAB_PAIR.size)
+        node, child_count, pos = read_node(pos)
+        stack[-1][0].children.append(((intern_name(strings[name]), value[0]), node))
+        stack.append([node, child_count])
+      return root
+    except (struct.error, IndexError, KeyError, UnicodeDecodeError) as e:
+      raise ValueError(f'Broken .seriab data: {e}')
 
   def get_children_by_id(self, id):
-    return [ item[1] for item in self.output_order if isinstance(item, tuple) and item[0][1] == id ]
+    return [ item[1] for item in self.children if item[0][1] == id ]
   
   def get_children_by_name(self, name):
-    return [ item[1] for item in self.output_order if isinstance(item, tuple) and item[0][0] == name ]
+    return [ item[1] for item in self.children if item[0][0] == name ]
+
+  def add_child(self, header, node):
+    '''Appends a child with a (name, id) header to the output'''
+    if not self.children: self.children = []
+    self.children.append((header, node))
+    self.shape = self.shape.with_child()
+    for index in self.indexed_by: index.clear()
+
+  def iter_subitems(self):
+    '''Lazily yields (header, node) pairs of all subnodes in the post-order, i.e. children before their parent and
+    the node itself last with a None header. Uses an explicit stack, so deep trees don't hit the recursion limit.'''
+    stack = [ (None, self, iter(self.children)) ]
+    while stack:
+      header, node, items = stack[-1]
+      for item in items:
+        stack.append((item[0], item[1], iter(item[1].children)))
+        break
+      else:
+        stack.pop()
+        yield header, node
+
+  def peek(self, attr, default=None):
+    '''Returns an output attribute or default, a lazy block answers it without being parsed'''
+    return getattr(self, attr) if attr in self.shape.visible else default
+
+  def iter_subnodes(self):
+    for header, node in self.iter_subitems():
+      yield node
+
+  def materialize_all(self):
+    '''Parses all lazy blocks of the tree, so it no longer refers to the file it was loaded from'''
+    for node in self.iter_subnodes(): pass
+    return self
+
+  def iter_find(self, attr, value=None):
+    '''Lazy find_by_attr, callers which need only the first hits can stop early'''
+    for node in self.iter_subnodes():
+      if attr in node.shape.visible and (value is None or getattr(node, attr) == value):
+        yield node
 
   def get_subnodes_as_list(self):
-    children = [ child[1].get_subnodes_as_list() for child in self.output_order if isinstance(child, tuple) ]
-    children = [ x for item in children for x in item ]
-    return children + [self]
+    return list(self.iter_subnodes())
 
   def find_by_attr(self, attr, value=None):
-    ch_found = [ child[1].find_by_attr(attr, value) for child in self.output_order if isinstance(child, tuple)  ]
-    found = [ x for item in ch_found for x in item ]
+    return list(self.iter_find(attr, value))
 
-    for m_attr in self.output_order:
-      if isinstance(m_attr, str):
-        if (m_attr == attr) and (value is None or getattr(self, attr) == value):
-          found.append(self)
-          break
-    return found
+  def find_first(self, attr, value=None):
+    '''Returns the first node find_by_attr would return or None. Uses the query index if it's already built,
+    otherwise stops the traversal on the first hit.'''
+    index = self.get_query_index()
+    if attr in index:
+      found = index[attr].get(tuple(value) if isinstance(value, list) else value)
+      return found[0] if found else None
+    return next(self.iter_find(attr, value), None)
+
+  def get_query_index(self):
+    '''Returns the lazily filled secondary index of this tree. The nodes a table was built from list the index in
+    indexed_by, so assigning an indexed attribute drops its table and adding or removing children drops them all.
+    Lists changed in place aren't noticed.'''
+    index = getattr(self, 'query_index', None)
+    if index is None: self.query_index = index = {}
+    return index
+
+  def watch(self, index):
+    '''Adds a query index to indexed_by'''
+    for other in self.indexed_by:
+      if other is index: return
+    self.indexed_by += (index,)
+
+  def query(self, attr, value=None):
+    '''Indexed version of find_by_attr returning the same nodes in the same order. The first query of an attribute
+    indexes all its values in one pass, repeated queries only cost as much as their results. The table of an
+    attribute is rebuilt after the attribute was assigned or the tree structure changed, see get_query_index.'''
+    index = self.get_query_index()
+    if attr not in index:
+      by_value = { None: [] }
+      for node in self.iter_subnodes():
+        node.watch(index)
+        if attr not in node.shape.visible: continue
+        node_value = getattr(node, attr)
+        by_value.setdefault(tuple(node_value) if isinstance(node_value, list) else node_value, []).append(node)
+        by_value[None].append(node)
+      index[attr] = by_value
+    
+    if isinstance(value, list): value = tuple(value)
+    return index[attr].get(value, [])[:]
+
+  def query_by_header(self, name=None, id=None):
+    '''Returns all subnodes (at any depth) with a given header name and/or id in get_subnodes_as_list order.
+    Uses the same lazily built index as query.'''
+    index = self.get_query_index()
+    if None not in index: #Attribute names are never None, so the header index is kept under this key
+      by_name, by_id = {}, {}
+      
+      for header, node in self.iter_subitems():
+        node.watch(index)
+        if header is None: continue
+        by_name.setdefault(header[0], []).append((header, node))
+        by_id.setdefault(header[1], []).append((header, node))
+      index[None] = (by_name, by_id)
+    
+    by_name, by_id = index[None]
+    if name is None: return [ node for header, node in by_id.get(id, []) ]
+    return [ node for header, node in by_name.get(name, []) if id is None or header[1] == id ]
 
   def get_nonchildren_attrs(self):
-    return [ item for item in self.output_order if isinstance(item, str) ]
+    names = self.shape.names
+    return [ names[i] for i in self.shape.order if i >= 0 ]
+
+  def pruned_copy(self, keep=(), share=()):
+    '''Copies the tree, but only the subtrees which survive the pruning. keep[depth](header, node) tells whether
+    a child on that depth is kept, deeper levels are kept entirely. Children named in share aren't copied but shared
+    with the original, use it only for nodes nobody changes in place, e.g. meshes.'''
+    root = type(self)()
+    stack = [ (self, root, 0) ]
+    while stack:
+      node, node_copy, depth = stack.pop()
+      for item in node.output_order:
+        if isinstance(item, tuple):
+          header, child = item
+          if depth < len(keep) and not keep[depth](header, child): continue
+          if header[0] in share:
+            node_copy.add_child(header, child)
+            continue
+          if isinstance(child, LazyNode):
+            if depth + 1 >= len(keep): #Kept entirely, the copy is another placeholder of the same block
+              node_copy.add_child(header, LazyNode(*child.lazy_block))
+              continue
+            child.materialize()
+          child_copy = type(child)()
+          node_copy.add_child(header, child_copy)
+          stack.append((child, child_copy, depth + 1))
+        else:
+          val = getattr(node, item)
+          node_copy.add_attr(item, copy.copy(val) if isinstance(val, (list, array)) else val)
+    return root
+
+  @staticmethod
+  def diff_key(header, node):
+    '''Key matching a child between two versions of a tree: its m_id, else its m_oid, else its header'''
+    for attr in ('m_id', 'm_oid'):
+      if attr in node.shape.visible:
+        value = getattr(node, attr)
+        if not isinstance(value, list): return (header[0], attr, value)
+    return (header[0], None, header[1])
+
+  def diff(self, other):
+    '''Returns a NodePatch turning this tree into other, or None if both have the same output. Children are matched
+    by diff_key, repeated keys by their position among the siblings with the same key. Untouched lazy blocks with
+    the same text are matched without parsing them.'''
+    if isinstance(self, LazyNode) and isinstance(other, LazyNode) and self.raw() == other.raw(): return None
+    
+    attrs = {}
+    for attr in other.get_nonchildren_attrs():
+      value = getattr(other, attr)
+      if attr not in self.shape.visible or not same_value(getattr(self, attr), value): attrs[attr] = value
+    
+    old_children, new_children = self.children, other.children
+    matches = [ None ] * len(new_children) #Index of the matched old child for each new one
+    for i, (old_item, new_item) in enumerate(zip(old_children, new_children)):
+      if (old_item[0] == new_item[0] and isinstance(old_item[1], LazyNode) and isinstance(new_item[1], LazyNode) and
+          old_item[1].raw() == new_item[1].raw()):
+        matches[i] = i #Unchanged in the same place
+    
+    #Children are matched by their keys first, those left by their headers and positions (ids change when a design is resaved)
+    for key_of in (Node.diff_key, lambda header, child: header[0]):
+      taken = set(matches)
+      old_indices, counts = {}, {}
+      for j, (header, child) in enumerate(old_children):
+        if j in taken: continue
+        key = (key_of(header, child),)
+        counts[key] = counts.get(key, 0) + 1
+        old_indices[key + (counts[key],)] = j
+      
+      counts = {}
+      for i, (header, child) in enumerate(new_children):
+        if matches[i] is not None: continue
+        key = (key_of(header, child),)
+        counts[key] = counts.get(key, 0) + 1
+        matches[i] = old_indices.get(key + (counts[key],))
+    
+    children = {}
+    for (header, child), j in zip(new_children, matches):
+      if j is None: continue
+      child_patch = old_children[j][1].diff(child)
+      if child_patch is not None: children[j] = child_patch
+    
+    new_items = iter([ (header, child if j is None else j) for (header, child), j in zip(new_children, matches) ])
+    layout = [ other.shape.names[i] if i >= 0 else next(new_items) for i in other.shape.order ]
+    old_items = iter([ (header, j) for j, (header, _) in enumerate(old_children) ])
+    if layout == [ self.shape.names[i] if i >= 0 else next(old_items) for i in self.shape.order ]: layout = None
+    
+    if not attrs and not children and layout is None: return None
+    return NodePatch(attrs, children, layout)
+
+  def check_patch(self, patch):
+    '''Raises ValueError if the patch does not fit this tree: its child indices, headers and attribute names are
+    checked against the nodes they refer to'''
+    stack = [ (self, patch) ]
+    while stack:
+      node, patch = stack.pop()
+      old_children = node.children
+      for attr in patch.attrs:
+        if not isinstance(attr, str) or attr in Node.direct_attrs or attr.startswith('__'):
+          raise ValueError(f'Cannot patch attribute {attr!r}')
+      for j, child_patch in patch.children.items():
+        if not isinstance(j, int) or not 0 <= j < len(old_children): raise ValueError(f'No child {j!r} to patch')
+        stack.append((old_children[j][1], child_patch))
+      
+      if patch.layout is None: continue
+      used = set()
+      for item in patch.layout:
+        if isinstance(item, str):
+          if item not in node.shape.index and item not in patch.attrs: raise ValueError(f'No attribute {item!r}')
+        elif isinstance(item[1], int):
+          j = item[1]
+          if not 0 <= j < len(old_children) or j in used: raise ValueError(f'No child {j!r} to place')
+          if old_children[j][0][0] != item[0][0]: raise ValueError(f'Child {j} is {old_children[j][0][0]}, not {item[0][0]}')
+          used.add(j)
+        elif not isinstance(item[1], Node): raise ValueError(f'Not a child: {item[1]!r}')
+
+  def apply_patch(self, patch, checked=False):
+    '''Applies a diff result in place, subtrees without changes aren't touched (and stay lazy if they are). New
+    children are shared with the patch. The whole patch is checked first, a patch not fitting the tree raises
+    ValueError and changes nothing.'''
+    if not checked: self.check_patch(patch)
+    old_children = list(self.children)
+    for j, child_patch in patch.children.items():
+      old_children[j][1].apply_patch(child_patch, True)
+    
+    for attr, value in patch.attrs.items():
+      setattr(self, attr, copy.copy(value) if isinstance(value, (list, array)) else value)
+    
+    if patch.layout is not None:
+      self.output_order = [ item if isinstance(item, str) else
+                            (item[0], old_children[item[1]][1] if isinstance(item[1], int) else item[1]) for item in patch.layout ]
+    return self
 
   @classmethod
   def from_file(cls, path, logger=Logger()):
+    if path.endswith(SERIAB_EXTENSION): return cls.from_binary_file(path, logger)
+    
+    ship = parse_cache.load(path, cls) if parse_cache is not None else None
+    if ship is not None: return ship
+    
+    stat = os.stat(path)
     with open(path, 'r', encoding="cp1251") as f:
-      text = f.read()
-      node_text, _, _ = parse_parenthesis(text)
-      ship = cls.parse_from_text(node_text, logger)
+      ship = cls.parse_from_lines(f, logger)
     
+    if ship is not None and parse_cache is not None: parse_cache.store(path, cls, ship, stat)
     return ship
 
   def get(self, attr, def_value):
@@ -96,122 +609,350 @@ class Node(object):
 
   def set(self, attr, value):
     setattr(self, attr, value)
-    if attr not in self.output_order:
-      self.output_order.append(attr)
+    shape = self.shape
+    if attr not in shape.visible:
+      self.shape = NodeShape.get(shape.names, shape.order + (shape.index[attr],))
 
   def remove(self, value):
-    if value in self.output_order:
-        self.output_order.remove(value)
+    output_order = self.output_order
+    if value in output_order:
+        output_order.remove(value)
+        self.output_order = output_order
+
+  def add_attr(self, attr, val):
+    '''Adds a parsed attr=value pair, values of a repeated attribute are collected into a list'''
+    shape = self.shape
+    i = shape.index.get(attr)
+    if i is None: #The hot path of parsing, so the slot is set directly
+      object.__setattr__(self, 'shape', shape.transitions.get(attr) or shape.with_attr(attr))
+      self.values.append(val)
+    elif isinstance(self.values[i], list):
+      self.values[i].append(val)
+    else:
+      self.values[i] = [ self.values[i] ] + [ val ]
+
+  def add_num(self, val):
+    '''Adds a bare number line, e.g. a mesh coordinate. Float sequences are kept in a compact array('d'), which
+    holds exactly the same values, a sequence with ints falls back to a list so the output does not change'''
+    i = self.shape.index.get('num_seq')
+    if i is None:
+      self.shape = self.shape.with_attr('num_seq')
+      self.values.append(array('d', [ val ]) if isinstance(val, float) else [ val ])
+      return
+    if isinstance(self.values[i], array) and not isinstance(val, float):
+      self.values[i] = self.values[i].tolist()
+    self.values[i].append(val)
   
+  @staticmethod
+  def parse_text_into_object_attrs(o, lines, logger=Logger()):
+    '''Parses attr=value and bare number lines into the node attributes'''
+    for line in lines:
+      attr, sep, val = line.partition('=')
+      if sep:
+        o.add_attr(attr, convert_to_python_type(val))
+      else:
+        val = convert_to_python_type(line)
+        if isinstance(val, str):
+          logger.log('Cannot parse line', line)
+          return False
+        o.add_num(val)
+    return True
+
   @classmethod
-  def parse_from_text(cls, text, logger=Logger()):
+  def iter_parse(cls, lines, logger=Logger()):
+    '''Incrementally builds a node tree from an iterable of text lines, e.g. an opened file, in a single pass.
+    Nodes under construction are kept on a stack, their attribute lines are buffered until the next child header
+    or the closing parenthesis. Yields a (header, node) pair as soon as a block is closed, the root node comes last
+    with a None header. Stops without yielding the root if the text cannot be parsed.'''
     
-    def parse_text_into_object_attrs(o, lines):
-      for line in lines:
-        try:
+    def split_buffer(buff):
+      text = '\n'.join(buff).strip()
+      return text.split('\n') if text else []
+    
+    stack = [] #(header, node, buffered attribute lines) triples
+    root_found = False
+    
+    for line in lines:
+      if line.endswith('\n'): line = line[:-1]
+      
+      if line == '{':
+        node = cls()
+        header = None
+        if stack:
+          parent, buff = stack[-1][1:]
+          attr_lines = split_buffer(buff)
+          if not attr_lines:
+            logger.log('Error: a child without header')
+            return
+          
+          if not cls.parse_text_into_object_attrs(parent, attr_lines[:-1], logger): return
+          
           try:
-            attr, val = line.split('=')
+            attr, val = attr_lines[-1].split('=')
           except:
-            desc_line = line.split('=')
-            if len(desc_line) < 3: raise ValueError('Passing this to num processing')
-            attr, val = desc_line[0], '='.join(desc_line[1:])
+            logger.log('Cannot parse header:', attr_lines[-1])
+            return
+          
+          header = (intern_name(attr), convert_to_python_type(val))
+          parent.add_child(header, node)
+          buff.clear()
+        stack.append((header, node, []))
+      elif not stack:
+        continue #Skip everything outside the root object
+      elif line == '}':
+        header, node, buff = stack.pop()
+        if not cls.parse_text_into_object_attrs(node, split_buffer(buff), logger): return
+        yield header, node
+        if not stack:
+          root_found = True
+          break
+      else:
+        stack[-1][2].append(line)
+    
+    if not root_found:
+      logger.log('Incorrect parsing')
 
-          try: val = literal_eval(val)
-          except: pass
+  @classmethod
+  def parse_from_lines(cls, lines, logger=Logger()):
+    obj = None
+    for header, node in cls.iter_parse(lines, logger):
+      if header is None: obj = node
+    return obj
 
-          if not hasattr(o, attr):
-            setattr(o, attr, val)
-            o.output_order.append(attr)
-          else:
-            if isinstance(getattr(o, attr), list):
-              attr_val = getattr(o, attr) + [ val ]
-              setattr(o, attr, attr_val)
-            else:
-              setattr(o, attr, [ getattr(o, attr) ] + [ val ])
-        except:
-          try: line = literal_eval(line)
-          except:
-            logger.log('Cannot parse line', line)
-            return False
+  @classmethod
+  def from_events(cls, events):
+    '''Builds nodes from the iter_events output. If the events were filtered by paths, every selected subtree
+    is attached with its header to a common root node in the file order, so get_children_by_name works as usual.'''
+    root = None
+    stack = []
+    
+    for event, path, data in events:
+      if event == 'attr':
+        stack[-1].add_attr(*data)
+      elif event == 'num':
+        stack[-1].add_num(data)
+      elif event == 'enter':
+        node = cls()
+        if stack:
+          stack[-1].add_child(data, node)
+        elif data is None:
+          root = node
+        else:
+          if root is None: root = cls()
+          root.add_child(data, node)
+        stack.append(node)
+      elif event == 'exit':
+        stack.pop()
+    
+    return root
 
-          if not hasattr(o, 'num_seq'):
-            o.num_seq = []
-            o.output_order.append('num_seq')
-          o.num_seq.append(line)
-      return True
+  @classmethod
+  def lazy_from_file(cls, path, logger=Logger(), mapped=True):
+    '''Parses only the root attributes of a memory-mapped file, child blocks are parsed on the first access and
+    copied verbatim on output while untouched. Returns None if the file cannot be parsed. With mapped=False the file
+    is read into memory instead, so it isn't held open while the tree is kept (e.g. a save the game may overwrite).'''
+    if path.endswith(SERIAB_EXTENSION): return cls.from_binary_file(path, logger) #Fast to load as a whole
     
-    obj = cls()
+    try:
+      source = LazySource(path, cls.encoding, mapped)
+      if not len(source.opens): raise ValueError('No root object')
+      return LazyNode(source, source.line_end(int(source.opens[0])), int(source.closes[0]), cls).materialize(logger)
+    except ValueError as e:
+      logger.log('Incorrect parsing:', e)
+      return None
 
-    text = text.strip()[1:-1].strip()
+  @classmethod
+  def from_binary_file(cls, path, logger=Logger()):
+    '''Loads a .seriab file, returns None if it's broken'''
+    with open(path, 'rb') as f:
+      data = f.read()
+    
+    try:
+      return cls.from_binary(data)
+    except ValueError as e:
+      logger.log('Incorrect parsing:', e)
+      return None
 
-    items = []
-    string_buff = []
-    i = 0
+  @classmethod
+  def extract_from_file(cls, path, paths, logger=Logger()):
+    '''Builds only the subtrees under given paths (see iter_events), skipping the rest of the file'''
+    with open(path, 'r', encoding="cp1251") as f:
+      node = cls.from_events(iter_events(f, paths, logger))
     
-    while i < len(text):
-      symbol = text[i]
+    return node
 
-      if not (symbol == '{' and i < len(text) - 1 and text[i+1] == '\n'):
-        string_buff.append(symbol)
-        i+=1
-      else:
-        items.append(''.join(string_buff))
-        string_buff = []
+  @classmethod
+  def parse_from_text(cls, text, logger=Logger()):
+    return cls.parse_from_lines(text.split('\n'), logger)
 
-        node_text, _, end_idx = parse_parenthesis(text[i:])
-        o = cls.parse_from_text(node_text)
-        if not o: return None
-        
-        i = i + end_idx
-        items.append(o)
+class LazyNode(Node):
+  '''Placeholder of a not yet parsed block of a LazySource. It turns into a normal node of the tree class on the
+  first attribute access, its own child blocks become LazyNodes in turn. A LazyNode nobody has touched is unchanged,
+  so its text is copied verbatim on output. Its table slots stay unset until then, so any access gets here.'''
+  __slots__ = ()
+
+  def __init__(self, source, start, end, cls):
+    self.lazy_block = (source, start, end, cls) #Block text offsets between the parenthesis lines
+
+  def __getattr__(self, attr):
+    if attr == 'lazy_block' or attr.startswith('__'): raise AttributeError(attr)
+    self.materialize()
+    return getattr(self, attr)
+
+  def __setattr__(self, attr, value):
+    if attr != 'lazy_block' and not attr.startswith('__'): self.materialize() #Parse first, or the parsed value overwrites it
+    Node.__setattr__(self, attr, value)
+
+  def __reduce_ex__(self, protocol):
+    self.materialize()
+    return self.__reduce_ex__(protocol)
+
+  def peek(self, attr, default=None):
+    '''Returns the value of an attribute of the block without parsing it, or default. Only the own lines of the block
+    are searched, a repeated attribute gives its first value.'''
+    source, start, end, cls = self.lazy_block
+    pattern = re.compile(b'^' + re.escape(attr.encode(source.encoding)) + rb'=([^\r\n]*)', re.M)
+    pos = start
+    while True:
+      block = source.next_block(pos, end)
+      own_end = end if block is None else source.data.rfind(b'\n', pos, block[0] - 1) + 1 #Up to the child header line
+      found = pattern.search(source.data, pos, max(own_end, pos))
+      if found: return convert_to_python_type(found.group(1).decode(source.encoding))
+      if block is None: return default
+      pos = source.line_end(block[1])
+
+  def text(self):
+    source, start, end, cls = self.lazy_block
+    return source.text(start, end)
+
+  def raw(self):
+    source, start, end, cls = self.lazy_block
+    return source.data[start:end]
+
+  def materialize(self, logger=Logger()):
+    source, start, end, cls = self.lazy_block
+    del self.lazy_block
+    self.__class__ = cls
+    Node.__init__(self)
     
-    if string_buff:
-      items.append(''.join(string_buff))
+    pos = start
+    while True:
+      block = source.next_block(pos, end)
+      lines = source.text(pos, end if block is None else block[0]).strip()
+      lines = lines.split('\n') if lines else []
+      if block is None:
+        if not cls.parse_text_into_object_attrs(self, lines, logger): raise ValueError('Cannot parse block')
+        return self
+      
+      if not lines:
+        logger.log('Error: a child without header')
+        raise ValueError('Cannot parse block')
+      if not cls.parse_text_into_object_attrs(self, lines[:-1], logger): raise ValueError('Cannot parse block')
+      
+      try:
+        attr, val = lines[-1].split('=')
+      except:
+        logger.log('Cannot parse header:', lines[-1])
+        raise ValueError('Cannot parse block')
+      
+      open_pos, close_pos = block
+      self.add_child((intern_name(attr), convert_to_python_type(val)), LazyNode(source, source.line_end(open_pos), close_pos, cls))
+      pos = source.line_end(close_pos)
 
-    last_item = None
-    items_checked = 0
-    if len(items) == 1:
-      if not parse_text_into_object_attrs(obj, items[0].strip().split('\n')): return None
-    else:
-      for item in items:
-        if isinstance(item, Node):
-          if not last_item or not isinstance(last_item, str):
-            logger.log('Error: a child without header')
-            return None
-          
-          lines = last_item.strip().split('\n')
-          if not parse_text_into_object_attrs(obj, lines[:-1]): return None
-          
-          try:
-            attr, val = lines[-1].split('=')
-          except:
-            logger.log('Cannot parse header:', lines[-1])
-            return None
-          
-          try: val = literal_eval(val)
-          except: pass
-
-          obj.output_order.append( ((attr, val), item) )
-          items_checked += 2
-        elif isinstance(item, str) and isinstance(last_item, str):
-          logger.log('Incorrect parsing')
-          return None
-        last_item = item
-      if len(items) - items_checked > 1:
-        logger.log('Incorrect parsing')
-        return None
-      elif len(items) - items_checked == 1:
-         lines = items[-1].strip().split('\n')
-         if not parse_text_into_object_attrs(obj, lines): return None
-    return obj
+class NodePatch(object):
+  '''Changes turning one node into another, see Node.diff. attrs maps changed and new attributes to their values,
+  children maps indices of the matched old children to their patches. layout is None if the output order and the
+  headers stay, otherwise it's the new output order of attribute names, (header, index of the old child) pairs and
+  (header, node) pairs of new children. base_hash is the text_hash of the file the patch was made against, if known.'''
+  __slots__ = ('attrs', 'children', 'layout', 'base_hash')
+
+  def __init__(self, attrs, children, layout, base_hash=None):
+    self.attrs = attrs
+    self.children = children
+    self.layout = layout
+    self.base_hash = base_hash
+
+  @staticmethod
+  def text_hash(path):
+    '''Hash of a file to check the base of a patch, line ends of a text file don't matter'''
+    with open(path, 'rb') as f:
+      data = f.read()
+    if not path.endswith(SERIAB_EXTENSION): data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    return hashlib.sha1(data).hexdigest()
+
+  def to_node(self):
+    '''Encodes the patch as a tree of plain values: an attrs child with the changed attributes, a (child, old index)
+    child per child patch and a layout child with an op node per output item. An op node has op=a and the name of
+    an attribute, op=o, the new header and the index of an old child, or op=n, the new header and the new child.'''
+    root = Node()
+    if self.base_hash is not None: root.add_attr('base_hash', self.base_hash)
+    attrs = Node()
+    for attr, value in self.attrs.items():
+      attrs.add_attr(attr, value)
+    root.add_child(('attrs', 0), attrs)
+    for j, child_patch in self.children.items():
+      root.add_child(('child', j), child_patch.to_node())
+    
+    if self.layout is not None:
+      layout = Node()
+      for item in self.layout:
+        op = Node()
+        if isinstance(item, str):
+          op.add_attr('op', 'a')
+          op.add_attr('name', item)
+        else:
+          header, target = item
+          op.add_attr('op', 'o' if isinstance(target, int) else 'n')
+          op.add_attr('name', header[0])
+          op.add_attr('id', header[1])
+          if isinstance(target, int): op.add_attr('index', target)
+          else: op.add_child(('node', 0), target)
+        layout.add_child(('op', 0), op)
+      root.add_child(('layout', 0), layout)
+    return root
+
+  @classmethod
+  def from_node(cls, root):
+    '''Decodes a to_node tree, raises ValueError if it isn't one'''
+    try:
+      attrs, children, layout = None, {}, None
+      for (name, j), node in root.children:
+        if name == 'attrs': attrs = { attr: getattr(node, attr) for attr in node.get_nonchildren_attrs() }
+        elif name == 'child': children[j] = cls.from_node(node)
+        elif name == 'layout':
+          layout = []
+          for header, op in node.children:
+            if op.op == 'a': layout.append(op.name)
+            elif op.op == 'o': layout.append(((op.name, op.id), op.index))
+            elif op.op == 'n' and len(op.children) == 1: layout.append(((op.name, op.id), op.children[0][1]))
+            else: raise ValueError(f'Unknown layout op {op.op!r}')
+        else: raise ValueError(f'Unknown patch item {name!r}')
+      if attrs is None: raise ValueError('No attrs')
+      return cls(attrs, children, layout, root.get('base_hash', None))
+    except AttributeError as e:
+      raise ValueError(f'Missing patch value: {e}')
+
+  def write(self, path):
+    with open(path, 'wb') as f:
+      f.write(SERIAPATCH_MAGIC + self.to_node().to_binary())
+
+  @classmethod
+  def from_file(cls, path):
+    '''Loads a patch written by write, raises ValueError if it's broken'''
+    with open(path, 'rb') as f:
+      data = f.read()
+    if data[:len(SERIAPATCH_MAGIC)] != SERIAPATCH_MAGIC: raise ValueError('Not a patch file or an unknown version')
+    return cls.from_node(Node.from_binary(data[len(SERIAPATCH_MAGIC):]))
 
 class Ship(Node):
   '''Wrapper for a Node object to work with ship configs'''
+  __slots__ = ()
+
   def __init__(self):
     super().__init__()
 
   def get_stats(self):
-    frame = self.find_by_attr('m_code', 47)[0]
+    frame = self.find_first('m_code', 47)
     return frame
     
   def rename(self, new_name):
@@ -242,6 +983,7 @@ class Ship(Node):
 
     #Make an exception for large fuel tanks
     
+    updated = []
     for child in children:
       try:    part_entry = parts.get_by_oid(child.m_oid)[0]
       except: continue
@@ -252,9 +994,14 @@ class Ship(Node):
 
       child_mesh.m_size   = parts_mesh.m_size
       child_mesh.num_seq  = parts_mesh.num_seq[:]
+      updated.append((child, part_entry))
+
+    #Masses of all updated modules are computed in one batch
+    masses = batch_compute_part_mass([ child for child, _ in updated ])
 
+    for (child, part_entry), mass in zip(updated, masses):
       #Update mass
-      child.m_mass = compute_part_mass(child)
+      child.m_mass = mass
       
       #Update non-child attrs
       for attr in part_entry.get_nonchildren_attrs():
@@ -296,7 +1043,7 @@ class Ship(Node):
         'm_tele_power_total'  : [ 'm_mdl_power', 'OL', 0, 0],
         'm_init_power' : [ 'm_mdl_power', 'OL', 0, 0],
         'm_tele_power_total_repaired' : [ 'm_mdl_power', 'OL', 0, 0],
-        'm_tele_mass' : [ compute_part_mass, 'parts', 0, 0 ]
+        'm_tele_mass' : [ lambda part: part_masses[id(part)], 'parts', 0, 0 ]
      }
 
     init_price  = 0
@@ -306,6 +1053,7 @@ class Ship(Node):
     
     stat_object = self.get_stats()
 
+    modules = []
     for child in children:
       oid  = child.m_oid
         
@@ -321,6 +1069,13 @@ class Ship(Node):
         logger.log(f'Cannot read a parts entry for {oid}, using the ship part value instead')
         part = child
       
+      modules.append((stat, part))
+    
+    #Module masses are computed in one batch and looked up by the part object during aggregation
+    module_parts = [ part for _, part in modules ]
+    part_masses  = { id(part): mass for part, mass in zip(module_parts, batch_compute_part_mass(module_parts)) }
+    
+    for stat, part in modules:
       for key in sum_stats.keys():
         module_stat, where, def_value, agg_value = sum_stats[key]
         db = stat if where == 'OL' else part
@@ -341,19 +1096,29 @@ class Ship(Node):
     #TODO: UPDATE HP PARAMS
     #Optional, since the game can do it itself
 
-#It may be better to rewrite child classes as wrapper classes for Node
-class OL(Node):
-  '''A Node child class to work with OL.seria'''
+class Library(Node):
+  '''A Node child class for library files with entries identified by m_oid. Lookups go through the query index,
+  so the m_oid -> entries table is built once and reused until an m_oid is assigned or entries are added or removed.
+  Other attributes of the entries can be changed freely, e.g. by the updater.'''
+  __slots__ = ()
+
   def __init__(self):
     super().__init__()
 
   def get_by_oid(self, oid):
-    return self.find_by_attr('m_oid', oid)
+    return self.query('m_oid', oid)
+
+#It may be better to rewrite child classes as wrapper classes for Node
+class OL(Library):
+  '''A Node child class to work with OL.seria'''
+  __slots__ = ()
 
-class Parts(Node):
-  '''A Node child class to work with parts.seria'''
   def __init__(self):
     super().__init__()
 
-  def get_by_oid(self, oid):
-    return self.find_by_attr('m_oid', oid)
\ No newline at end of file
+class Parts(Library):
+  '''A Node child class to work with parts.seria'''
+  __slots__ = ()
+
+  def __init__(self):
+    super().__init__()
@@ -1,6 +1,9 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 from parsing import *
 
-def sample_radiation_value(known_values=[]):
+def sample_radiation_value(known_values=[], rng=None):
+    rng = rng or id_allocator.rng
     if len(known_values) > 3:
         mean = np.mean(known_values)
         std  = np.std(known_values, ddof=-1)
@@ -9,31 +12,78 @@ def sample_radiation_value(known_values=[]):
         std = 1.0
     
     while True:
-        value = np.random.randn() * std + mean
+        value = rng.standard_normal() * std + mean
         if value > 0:
             return value
 
-def get_compacted_ship_repr(ship, escadra_m_id, escadra_index):
-    ship = copy.deepcopy(ship)
+#(OL, vanilla OL, parts) parsed once by the caller of update_ships and sent to each worker on its start
+update_libraries = None
+
+def init_update_worker(ol, vanilla_ol, parts):
+    global update_libraries
+    update_libraries = (ol, vanilla_ol, parts)
+
+def update_ship_file(path, out_path):
+    '''Updates a single ship file with the libraries set by init_update_worker, returns its log lines'''
+    ol, vanilla_ol, parts = update_libraries
+    logger = BufferLogger()
+    logger.log(f'Updating {os.path.basename(path)}')
+    
+    ship = Ship.from_file(path, logger)
+    try:
+        ship.recompute_stats(ol, vanilla_ol, parts, logger=logger, verbose=True)
+        ship.write(out_path, logger=logger)
+    except:
+        try:
+            logger.log('Cannot update global stats, recomputing local only.')
+            ship = Ship.from_file(path, logger=logger)
+            ship.update_modules(parts, ol, vanilla_ol)
+            ship.write(out_path, logger=logger)
+        except:
+            logger.log('Cannot update')
+            logger.log('---------------------------')
+    logger.log('')
+    return logger.lines
+
+def update_ships(paths, out_paths, ol, vanilla_ol, parts, jobs=1):
+    '''Updates ship files using a pool of worker processes. Yields log lines of every ship in the input order.'''
+    if jobs <= 1:
+        init_update_worker(ol, vanilla_ol, parts)
+        for path, out_path in zip(paths, out_paths):
+            yield update_ship_file(path, out_path)
+        return
+    
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_update_worker, initargs=(ol, vanilla_ol, parts)) as pool:
+        yield from pool.map(update_ship_file, paths, out_paths)
+
+#Pruning of a donor ship down to its compacted repr: the single m_children=31 frame node on the upper level, only meshes
+#and the bridge inside the frame. Meshes are shared with the donor, they're never changed in place.
+compacted_ship_keep = ( lambda header, node: header[1] == 31,
+                        lambda header, node: header[0] == 'm_mesh' or node.peek('m_name') == 'COMBRIDGE' )
+
+def get_compacted_ship_repr(ship, escadra_m_id, escadra_index, rng=None, allocator=None):
+    '''rng (a numpy Generator) and allocator default to the ones of the global id_allocator, pass seeded ones for
+    reproducible results'''
+    allocator = allocator or id_allocator
+    rng = rng or allocator.rng
     
-    owner = generate_id()
+    #Copy only attr=value pairs and the subnode containing bridge. Lazy blocks left in it would keep the design file
+    #open (and on Windows locked) for as long as the escadra exists, so they're parsed here
+    ship = ship.pruned_copy(compacted_ship_keep, share=('m_mesh',)).materialize_all()
     
-    #Prune all children except attr=value pairs or a subnode containing bridge
-    ship.output_order = [ item for item in ship.output_order if type(item) == str or item[0][1] == 31 ]
+    owner, ship_id, frame_id, combridge_id = allocator.allocate(4)
     
     #Utility vars
-    ship.set('m_id', generate_id())
+    ship.set('m_id', ship_id)
     ship.set('m_master_id', escadra_m_id)
     
     #Magic var, dunno what it does
     ship.set('m_state', 2)
     
     #Go one step deeper
-    frame = ship.get_children_by_name('m_children')[0] #Get the single m_children=31 node
-    #Prune it the same we pruned an upper level node, leaving only attr=value, meshes or bridge
-    frame.output_order = [ item for item in frame.output_order if type(item) == str or item[0][0] == 'm_mesh' or (hasattr(item[1], 'm_name') and item[1].m_name == 'COMBRIDGE')  ]
+    frame = ship.get_children_by_name('m_children')[0] #Get the single m_children=31 node, already pruned to attr=value, meshes or bridge
     #Utility vars
-    frame.set('m_id', generate_id())
+    frame.set('m_id', frame_id)
     frame.set('m_master_id', ship.m_id)
     frame.set('m_owner_id', owner)
     
@@ -42,14 +92,14 @@ def get_compacted_ship_repr(ship, escadra_m_id, escadra_index):
     
     #Prepare combridge
     combridge = frame.get_children_by_id(15)[0]
-    combridge.set('m_id', generate_id())
+    combridge.set('m_id', combridge_id)
     combridge.set('m_master_id', frame.m_id)
     combridge.set('m_owner_id', owner)
     
     #Prepare creature
     creature = combridge.get_children_by_id(47)[0]
     
-    m_name = 'PROFILE@№' + ''.join([ str(np.random.randint(0, 9)) for _ in range(3)])
+    m_name = 'PROFILE@№' + ''.join([ str(x) for x in rng.integers(0, 9, size=3) ])
     #dunno why we need to set ownership, but let it be
     creature.set('m_id', owner)
     creature.set('m_master_id', combridge.m_id)
@@ -65,7 +115,7 @@ def get_compacted_ship_repr(ship, escadra_m_id, escadra_index):
     #m_escadra_index used for initial ordering
     creature.set('m_escadra_index', escadra_index)
     #m_radiation_extra <-- sampled based on other ship values
-    creature.set('m_radiation_extra', sample_radiation_value())
+    creature.set('m_radiation_extra', sample_radiation_value(rng=rng))
         
     creature.remove('creatureId')
     creature.remove('m_damageCounter')
@@ -74,8 +124,10 @@ def get_compacted_ship_repr(ship, escadra_m_id, escadra_index):
     
     return ship
                 
-def replace_escadra_ships(escadra, ship_list):
+def replace_escadra_ships(escadra, ship_list, rng=None, allocator=None):
   '''deprecated in the GUI version, used for reference'''
+  allocator = allocator or id_allocator
+  rng = rng or allocator.rng
   #escadra = copy.deepcopy(escadra)
 
   radiation_values = []
@@ -87,7 +139,7 @@ def replace_escadra_ships(escadra, ship_list):
   escadra_indices = []
   
   for ship in escadra.get_children_by_name('m_children'):
-    creature = ship.find_by_attr('m_name', 'COMBRIDGE')[0].get_children_by_id(47)[0]
+    creature = ship.query('m_name', 'COMBRIDGE')[0].get_children_by_id(47)[0]
     rad = creature.m_radiation_extra if hasattr(creature, 'm_radiation_extra') else 0.0
     radiation_values.append(rad)
     
@@ -100,19 +152,17 @@ def replace_escadra_ships(escadra, ship_list):
   m_id = escadra.m_id
   new_ships = []
   for i, donor_ship in enumerate(ship_list):
-    owner = generate_id()
+    owner, ship_id, frame_id, combridge_id = allocator.allocate(4)
 
-    donor_ship = copy.deepcopy(donor_ship)
-    donor_ship.output_order = [ item for item in donor_ship.output_order if type(item) == str or item[0][1] == 31 ]
-    donor_ship.set('m_id', generate_id())
+    donor_ship = donor_ship.pruned_copy(compacted_ship_keep, share=('m_mesh',)).materialize_all()
+    donor_ship.set('m_id', ship_id)
     donor_ship.set('m_master_id', m_id)
     donor_ship.set('m_state', 2)
 
     ########
     frame = donor_ship.get_children_by_name('m_children')[0]
-    frame.output_order = [ item for item in frame.output_order if type(item) == str or item[0][0] == 'm_mesh' or (hasattr(item[1], 'm_name') and item[1].m_name == 'COMBRIDGE')  ]
     frame.set('m_master_id', donor_ship.m_id)
-    frame.set('m_id', generate_id())
+    frame.set('m_id', frame_id)
     #m_owner_id
     frame.set('m_owner_id', owner)
     
@@ -121,7 +171,7 @@ def replace_escadra_ships(escadra, ship_list):
     
     #Prepare combridge
     combridge = frame.get_children_by_id(15)[0]
-    combridge.set('m_id', generate_id())
+    combridge.set('m_id', combridge_id)
     combridge.set('m_master_id', frame.m_id)
     #m_owner_id
     combridge.set('m_owner_id', owner)
@@ -129,7 +179,7 @@ def replace_escadra_ships(escadra, ship_list):
     #Prepare creature
     creature = combridge.get_children_by_id(47)[0]
     
-    m_name = 'PROFILE@ยน' + ''.join([ str(np.random.randint(0, 9)) for _ in range(3)])
+    m_name = 'PROFILE@ยน' + ''.join([ str(x) for x in rng.integers(0, 9, size=3) ])
     #m_owner_id?
     creature.set('m_id', owner)
     creature.set('m_master_id', combridge.m_id)
@@ -145,7 +195,7 @@ def replace_escadra_ships(escadra, ship_list):
     #m_escadra_index <-- ordering?
     creature.set('m_escadra_index', i+1)
     #m_radiation_extra <-- sampled based on other ship values
-    creature.set('m_radiation_extra', sample_radiation_value(radiation_values))
+    creature.set('m_radiation_extra', sample_radiation_value(radiation_values, rng))
     
     creature.remove('creatureId')
     creature.remove('m_damageCounter')
@@ -1,6 +1,15 @@
 from ast import literal_eval
 import numpy as np
 import copy
+import re
+import os
+import pickle
+import hashlib
+import mmap
+import weakref
+import sys
+import struct
+from array import array
 
 class Logger:
     def __init__(self):
@@ -9,12 +18,171 @@ class Logger:
     def log(self, * args, ** kwargs):
         print(*args, **kwargs)
 
+class BufferLogger(Logger):
+    '''Collects log lines instead of printing them, e.g. to pass them back from a worker process'''
+    def __init__(self):
+        self.lines = []
+    
+    def log(self, * args, ** kwargs):
+        self.lines.append(' '.join([ str(arg) for arg in args ]))
+
 class ShipEntry(object):
     def __init__(self, ship_names, difficulties=['easy', 'normal', 'hard'], spawn_chance=1.0):
         self.names = ship_names
         self.difficulties = difficulties
         self.spawn_chance = spawn_chance
             
+class ParseCache(object):
+  '''On-disk cache of parsed .seria trees. An entry is keyed by the source path and the node class and stores the
+  source mtime, size and content hash next to the pickled tree. An entry with the same mtime and size is a hit
+  right away, otherwise the content hash decides, so touched or copied back files are still hits. The least
+  recently used entries are evicted once the cache grows over max_size bytes.'''
+  version = 3 #Bump when the parser output changes to drop all old entries
+  
+  def __init__(self, root, max_size=512 * 2 ** 20):
+    self.root = root
+    self.max_size = max_size
+  
+  @staticmethod
+  def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(2 ** 20), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+  
+  def entry_path(self, path, cls):
+    key = f'{os.path.abspath(path)}|{cls.__module__}.{cls.__qualname__}|{self.version}'
+    return os.path.join(self.root, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pickle')
+  
+  def load(self, path, cls):
+    '''Returns the cached tree or None on a miss'''
+    entry_path = self.entry_path(path, cls)
+    try:
+      stat = os.stat(path)
+      with open(entry_path, 'rb') as f:
+        header = pickle.load(f)
+        if (header['mtime'], header['size']) != (stat.st_mtime_ns, stat.st_size):
+          if header['size'] != stat.st_size or header['hash'] != self.file_hash(path):
+            return None
+        node = pickle.load(f)
+      os.utime(entry_path) #Mark as recently used
+      return node
+    except Exception:
+      return None
+  
+  def store(self, path, cls, node, stat):
+    '''Stores a tree parsed from the file with the given os.stat result, skipped if the file has changed since'''
+    try:
+      if os.stat(path).st_mtime_ns != stat.st_mtime_ns: return
+      header = { 'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'hash': self.file_hash(path) }
+      
+      os.makedirs(self.root, exist_ok=True)
+      entry_path = self.entry_path(path, cls)
+      tmp_path = f'{entry_path}.{os.getpid()}.tmp'
+      with open(tmp_path, 'wb') as f:
+        pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(node, f, pickle.HIGHEST_PROTOCOL)
+      os.replace(tmp_path, entry_path) #Atomic, parallel workers may store the same file
+      self.evict()
+    except Exception:
+      pass
+  
+  def evict(self):
+    entries = []
+    for name in os.listdir(self.root):
+      if name.endswith('.pickle'):
+        entry_path = os.path.join(self.root, name)
+        entries.append((os.path.getmtime(entry_path), os.path.getsize(entry_path), entry_path))
+    
+    total = sum([ size for _, size, _ in entries ])
+    for _, size, entry_path in sorted(entries):
+      if total <= self.max_size: break
+      os.remove(entry_path)
+      total -= size
+
+#Used by Node.from_file, set the HF_SERIA_CACHE environment variable to an empty string to disable it
+parse_cache_dir = os.environ.get('HF_SERIA_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'hf_seria'))
+parse_cache = ParseCache(parse_cache_dir) if parse_cache_dir else None
+
+class LazySource(object):
+  '''A memory-mapped (or with mapped=False read into memory) .seria file shared by the lazy nodes of a tree. A mapped
+  file can't be replaced on Windows, so trees kept for long should use a read one. Positions of the lines holding a single
+  parenthesis are found with numpy once, each opening one is matched to its closing one, so a block can be
+  skipped or located by its byte offsets without reading it.'''
+  sources = weakref.WeakSet() #Open sources, see release_all
+  id_pattern = re.compile(rb'^[^=\r\n]*[_.]id=([-+]?(?:0+|[1-9][0-9]*))\r?$', re.M) #Int values of m_id and *_id/*.id lines
+  
+  def __init__(self, path, encoding, mapped=True):
+    self.path = os.path.abspath(path)
+    self.encoding = encoding
+    with open(path, 'rb') as f:
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if mapped else f.read()
+    if mapped: LazySource.sources.add(self)
+    
+    buff = np.frombuffer(self.data, dtype=np.uint8)
+    self.opens  = self.alone_on_line(buff, ord('{'))
+    closes = self.alone_on_line(buff, ord('}'))
+    
+    #Blocks nest properly, so ordered by depth and then by position, each opening parenthesis is followed by its pair
+    positions = np.concatenate([ self.opens, closes ])
+    steps = np.concatenate([ np.ones(len(self.opens), dtype=np.int64), -np.ones(len(closes), dtype=np.int64) ])
+    order = np.argsort(positions, kind='stable')
+    positions, steps = positions[order], steps[order]
+    depths = np.cumsum(steps) + (steps < 0) #Depth of the block a parenthesis belongs to
+    order = np.lexsort((positions, depths))
+    positions, steps = positions[order], steps[order]
+    if len(positions) % 2 or np.any(steps[0::2] != 1) or np.any(steps[1::2] != -1):
+      raise ValueError(f'Unbalanced parenthesis in {path}')
+    
+    self.opens, self.closes = positions[0::2], positions[1::2]
+    order = np.argsort(self.opens)
+    self.opens, self.closes = self.opens[order], self.closes[order]
+  
+  @staticmethod
+  def alone_on_line(buff, char):
+    '''Positions of the char in lines consisting of it only, optionally ended by \r\n'''
+    found = np.flatnonzero(buff == char)
+    before = np.ones(len(found), dtype=bool)
+    before[found > 0] = buff[found[found > 0] - 1] == 10
+    after = np.ones(len(found), dtype=bool)
+    inside = found + 1 < len(buff)
+    next_chars = buff[found[inside] + 1]
+    after[inside] = (next_chars == 10) | ((next_chars == 13) & (buff[np.minimum(found[inside] + 2, len(buff) - 1)] == 10))
+    return found[before & after]
+  
+  def next_block(self, start, end):
+    '''Returns (open, close) positions of the first block starting in [start, end) or None'''
+    i = np.searchsorted(self.opens, start)
+    if i == len(self.opens) or self.opens[i] >= end: return None
+    return int(self.opens[i]), int(self.closes[i])
+  
+  def line_end(self, pos):
+    '''Offset right after the newline ending the line at pos'''
+    end = self.data.find(b'\n', pos)
+    return len(self.data) if end < 0 else end + 1
+  
+  def text(self, start, end):
+    text = self.data[start:end].decode(self.encoding)
+    if '\r' in text: text = text.replace('\r\n', '\n').replace('\r', '\n') #Same as reading in the text mode
+    return text
+  
+  def reference_ids(self, start, end):
+    '''Values of the m_id and *_id/*.id int attributes of a block and its children, found without parsing it'''
+    return [ int(id) for id in self.id_pattern.findall(self.data, start, end) ]
+  
+  def release(self):
+    '''Replaces the mapping by an in-memory copy, so the file can be replaced or removed'''
+    if isinstance(self.data, mmap.mmap):
+      data = self.data
+      self.data = data[:]
+      data.close()
+  
+  @classmethod
+  def release_all(cls, path):
+    for source in list(cls.sources):
+      if source.path == os.path.abspath(path): source.release()
+
 def parse_parenthesis(text):
   '''Parses a text between a pair of parenthesis on the same level and which are preceded by newlines.
   That typically denotes a single HF config object, which may recursively contain further objects.'''
@@ -42,15 +210,76 @@ def parse_parenthesis(text):
   
   return None
 
+#.seria scalars are decimal ints and floats (incl. the 1.8e+06 form), everything else, such as true/false flags,
+#names and captions, is kept as a raw string. Decimal numbers are decoded the way literal_eval did: all-zero digits
+#such as 00 are int 0, other digits with a leading zero such as 007 are strings, a float needs a point or an exponent.
+#Hex, underscores and complex numbers, which literal_eval also took, stay strings and are output as written
+INT_PATTERN   = re.compile(r'[-+]?(?:0+|[1-9][0-9]*)\Z')
+FLOAT_PATTERN = re.compile(r'[-+]?(?:(?:[0-9]+\.[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?|[0-9]+[eE][-+]?[0-9]+)\Z')
+NUMBER_CHARS  = frozenset('0123456789-+.')
+
+#Attribute and child names are few, but each of them repeats up to hundreds of thousands of times in a save. Interned
+#names are kept once and compared by identity first, e.g. in item[0][0] == 'm_children'
+intern_name = sys.intern
+
+#Short string values like classnames and true/false flags are shared through a bounded table as well. Captions and
+#other long strings rarely repeat, and the table stops growing when it's full
+MAX_INTERNED_VALUES = 4096
+MAX_INTERNED_LENGTH = 32
+interned_values = {}
+
+def intern_value(string):
+  shared = interned_values.get(string)
+  if shared is not None: return shared
+  if len(string) <= MAX_INTERNED_LENGTH and len(interned_values) < MAX_INTERNED_VALUES:
+    interned_values[string] = string
+  return string
+
 def convert_to_python_type(string):
-  '''Evaluates a string containing value and parses it into a Python data type'''
-  output = None
-  try:
-    output = literal_eval(string)
-  except:
-    output = string
-  
-  return output
+  '''Decodes a .seria value string into an int or a float, other values are returned as is (interned if short)'''
+  if string and string[0] in NUMBER_CHARS:
+    if INT_PATTERN.match(string): return int(string)
+    if FLOAT_PATTERN.match(string): return float(string)
+  return intern_value(string)
+
+#.seriab is the binary form of a node tree, see Node.to_binary. Kinds of values: q int, d float, s string, b int out
+#of the int64 range and x any other value, both kept as their text, n array('d') and l list. Strings are indices
+#of the string table, an array keeps its length and a list the format of its items, their data follows
+SERIAB_EXTENSION = '.seriab'
+SERIAB_MAGIC     = b'SERIAB\x00\x01' #The last byte is the format version
+SERIAPATCH_MAGIC = b'SERIAPATCH\x00\x01' #A NodePatch.to_node tree in the .seriab format follows
+SERIAB_CODES     = { 'q': 'q', 'd': 'd', 's': 'I', 'b': 'I', 'x': 'I', 'n': 'I', 'l': 'I' }
+SERIAB_UINT      = struct.Struct('<I')
+SERIAB_PAIR      = struct.Struct('<II') #Layout and format indices of a node, name and format indices of a header
+
+def seriab_kind(value):
+  '''Returns the .seriab kind of a value, anything unknown is kept as str(value), which is what the output writes'''
+  if isinstance(value, float): return 'd'
+  if isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+    return 'q' if -2 ** 63 <= value < 2 ** 63 else 'b'
+  if isinstance(value, str): return 's'
+  if isinstance(value, array) and value.typecode == 'd': return 'n'
+  if isinstance(value, list): return 'l'
+  return 'x'
+
+def float_array_bytes(seq):
+  '''Little-endian bytes of an array('d')'''
+  if sys.byteorder == 'little': return seq.tobytes()
+  seq = array('d', seq)
+  seq.byteswap()
+  return seq.tobytes()
+
+def float_array_from_bytes(data):
+  seq = array('d')
+  seq.frombytes(data)
+  if sys.byteorder != 'little': seq.byteswap()
+  return seq
+
+def same_value(a, b):
+  '''Compares parsed values as the output sees them, e.g. 1 and 1.0 differ'''
+  if type(a) is not type(b): return False
+  if isinstance(a, list): return len(a) == len(b) and all(map(same_value, a, b))
+  return a == b
 
 def max_level(text):
   '''Checks max depth of parenthesized objects in the text'''
@@ -66,34 +295,175 @@ def max_level(text):
 
   return max_level
 
+def iter_events(lines, paths=None, logger=Logger()):
+  '''SAX-style scanner over .seria text lines which does not build any nodes. Yields (event, path, data) tuples:
+    ('enter', path, header) when an object block is opened, header is an (attr, value) pair or None for the root;
+    ('attr',  path, (attr, value)) for attr=value lines;
+    ('num',   path, value) for bare number lines, e.g. mesh coordinates;
+    ('exit',  path, header) when the block is closed.
+  path is a tuple of child header names from the root down to the current object. paths optionally restricts
+  the output to the subtrees under given paths, e.g. [ 'm_escadras', 'm_locations' ] or [ 'm_escadras/m_children' ].
+  Blocks which can not contain a requested path are skipped without decoding any values.'''
+  if paths is not None:
+    paths = [ tuple(p.split('/')) if isinstance(p, str) else tuple(p) for p in paths ]
+
+  stack = [] #(header, path, selected) triples of open blocks
+  pending = None #Last line seen, it's either an attribute or a header of the next block
+  skip = 0
+  
+  for line in lines:
+    if line.endswith('\n'): line = line[:-1]
+    
+    if skip:
+      if line == '{': skip += 1
+      elif line == '}': skip -= 1
+      continue
+    
+    if line == '{':
+      if stack:
+        if pending is None:
+          logger.log('Error: a child without header')
+          return
+        attr, sep, val = pending.partition('=')
+        if not sep:
+          logger.log('Cannot parse header:', pending)
+          return
+        pending = None
+        header = (intern_name(attr), convert_to_python_type(val))
+        path = stack[-1][1] + (attr,)
+        selected = stack[-1][2] or any(path[:len(p)] == p for p in paths)
+        if not selected and not any(p[:len(path)] == path for p in paths):
+          skip = 1
+          continue
+      else:
+        header, path = None, ()
+        selected = paths is None or () in paths
+      
+      stack.append((header, path, selected))
+      if selected: yield 'enter', path, header
+      continue
+    
+    if not stack or not line: continue
+    
+    if pending is not None and stack[-1][2]:
+      attr, sep, val = pending.partition('=')
+      if sep:
+        yield 'attr', stack[-1][1], (attr, convert_to_python_type(val))
+      else:
+        val = convert_to_python_type(pending)
+        if isinstance(val, str):
+          logger.log('Cannot parse line', pending)
+          return
+        yield 'num', stack[-1][1], val
+    pending = None
+    
+    if line == '}':
+      header, path, selected = stack.pop()
+      if selected: yield 'exit', path, header
+      if not stack: return
+    else:
+      pending = line
+  
+  logger.log('Incorrect parsing')
+
+def mesh_points(mesh_object):
+  '''Returns mesh vertices as an N x 2 table. Meshes parsed into array('d') are viewed without copying'''
+  if isinstance(mesh_object.num_seq, array):
+    return np.frombuffer(mesh_object.num_seq, dtype=np.float64).reshape(-1, 2)
+  return np.array(mesh_object.num_seq, dtype=np.float64).reshape(-1, 2)
+
+def batch_mesh_geometry(meshes):
+  '''Computes areas and thicknesses (min from width/height) of many meshes at once, e.g. every module of a ship or
+  of a whole directory of designs. Vertices are packed into one ragged table (a concatenated N x 2 array plus
+  offsets), meshes with equal vertex counts are then processed together. Shoelace terms are accumulated with
+  cumsum, i.e. in the same order as a plain loop over the vertices, so results do not depend on the batch.'''
+  tables = [ mesh_points(mesh) for mesh in meshes ]
+  sizes  = np.array([ len(table) for table in tables ], dtype=np.int64)
+  starts = np.cumsum(sizes) - sizes
+  points = np.concatenate(tables) if tables else np.empty((0, 2))
+
+  areas       = np.zeros(len(tables))
+  thicknesses = np.zeros(len(tables))
+
+  for size in np.unique(sizes):
+    if size == 0: continue
+    idx = np.flatnonzero(sizes == size)
+    P = points[starts[idx, None] + np.arange(size)] #M x size x 2
+    X, Y = P[:, :, 0], P[:, :, 1]
+
+    #Gauss' formula terms: x[i] * y[i+1] - x[i+1] * y[i]
+    terms = np.empty((len(idx), 2 * size))
+    terms[:, 0::2] = X * np.roll(Y, -1, axis=1)
+    terms[:, 1::2] = -(np.roll(X, -1, axis=1) * Y)
+
+    areas[idx]       = np.abs(np.cumsum(terms, axis=1)[:, -1]) / 2
+    thicknesses[idx] = (P.max(axis=1) - P.min(axis=1)).min(axis=1)
+
+  return areas, thicknesses
+
 def shoelace_area(mesh_object):
   '''Computes the mesh area using the Gauss' fomula'''
-  X = mesh_object.num_seq[::2]
-  Y = mesh_object.num_seq[1::2]
+  areas, _ = batch_mesh_geometry([ mesh_object ])
+  return float(areas[0])
 
-  area = 0
+def batch_compute_part_mass(parts):
+  '''Vectorized compute_part_mass over a list of parts, returns an array of masses in the same order'''
+  meshes = [ part.get_children_by_name('m_mesh')[0] for part in parts ]
+  dens   = np.array([ part.m_density for part in parts ], dtype=np.float64)
 
-  for i in range(len(X)):
-    area += X[i] * Y[ (i+1) % len(Y) ]
-    area -= X[ (i+1) % len(X) ] * Y[i]
-
-  area = abs(area) / 2
-  return area
+  areas, thicknesses = batch_mesh_geometry(meshes)
+  return areas * dens * thicknesses
 
 def compute_part_mass(part):
-  mesh = part.get_children_by_name('m_mesh')[0]
-  dens = part.m_density
-
-  X, Y = mesh.num_seq[::2], mesh.num_seq[1::2]
-  P = np.stack([X, Y]).T #N x 2 point table
-  D = (P.max(axis=0) - P.min(axis=0)).min() #Min from width/height
-
-  return shoelace_area(mesh) * dens * D
-
-def generate_id(len=19):
-  sign = 1 if np.random.rand() <= 0.5 else -1
-  num = 0
-  for dig in [ np.random.randint(0, 9) for _ in range(len) ]:
-    num = num * 10 + dig
-  num *= sign
-  return num
\ No newline at end of file
+  return batch_compute_part_mass([ part ])[0]
+
+class IdAllocator(object):
+  '''Hands out unique random signed 63-bit object IDs. IDs are drawn from a seeded numpy Generator in blocks, so
+  each ID costs a pop from a list. IDs already present in a loaded save can be reserved and are never handed out,
+  neither is any ID twice.'''
+  def __init__(self, seed=None, block_size=1024):
+    self.rng = np.random.default_rng(seed)
+    self.block_size = block_size
+    self.used = set()
+    self.pool = []
+  
+  def reserve(self, ids):
+    ids = set(ids)
+    self.pool = [ id for id in self.pool if id not in ids ]
+    self.used |= ids
+  
+  def reserve_tree(self, node):
+    '''Reserves values of all m_id and *_id/*.id reference attributes in a tree. Untouched lazy blocks are scanned
+    as bytes, so reserving doesn't parse them.'''
+    ids, stack = [], [ node ]
+    while stack:
+      subnode = stack.pop()
+      lazy_block = getattr(subnode, 'lazy_block', None)
+      if lazy_block is not None:
+        source, start, end, cls = lazy_block
+        ids.extend(source.reference_ids(start, end))
+        continue
+      
+      for attr in subnode.get_nonchildren_attrs():
+        if attr == 'm_id' or attr.endswith('_id') or attr.endswith('.id'):
+          val = getattr(subnode, attr)
+          ids.extend([ x for x in (val if isinstance(val, list) else [ val ]) if isinstance(x, int) ])
+      stack.extend([ child for header, child in subnode.children ])
+    self.reserve(ids)
+  
+  def allocate(self, n):
+    '''Returns a list of n new IDs'''
+    while len(self.pool) < n:
+      block = self.rng.integers(-2 ** 63 + 1, 2 ** 63, size=max(self.block_size, n - len(self.pool)), dtype=np.int64)
+      for id in block.tolist():
+        if id != 0 and id not in self.used:
+          self.used.add(id)
+          self.pool.append(id)
+    ids, self.pool = self.pool[:n], self.pool[n:]
+    return ids
+
+#Default allocator used by generate_id, reserve the IDs of a loaded save on it before adding new objects
+id_allocator = IdAllocator()
+
+def generate_id(allocator=None):
+  return (allocator or id_allocator).allocate(1)[0]
\ No newline at end of file
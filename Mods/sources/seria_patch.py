@@ -0,0 +1,65 @@
+import argparse
+import os
+from utils.parsing import *
+
+parser = argparse.ArgumentParser(description='Structural .seria patches. With --new makes a patch turning --old into --new, otherwise applies --patch to --old. Directories pair files by name.')
+
+parser.add_argument('--old', type=str,
+                    help='original file or directory.')
+parser.add_argument('--new', type=str,
+                    help='modified file or directory, a patch is made if set.', default=None)
+parser.add_argument('--patch', type=str,
+                    help='patch file or directory to write or to apply.')
+parser.add_argument('--output', type=str,
+                    help='patched file or directory, --old is overwritten if not set.', default=None)
+
+PATCH_EXTENSION = '.seriapatch'
+
+def paired_paths(args):
+    '''Returns (old, new or patch, output) path triples of the file or the directory mode'''
+    other = args.new if args.new else args.patch
+    output = args.patch if args.new else (args.output if args.output else args.old)
+    if not os.path.isdir(args.old):
+        return [ (args.old, other, output) ]
+
+    os.makedirs(output, exist_ok=True)
+    triples = []
+    for item in sorted(os.listdir(args.old)):
+        if not item.endswith(('.seria', SERIAB_EXTENSION)): continue
+        if args.new: triples.append((os.path.join(args.old, item), os.path.join(other, item), os.path.join(output, item + PATCH_EXTENSION)))
+        else:        triples.append((os.path.join(args.old, item), os.path.join(other, item + PATCH_EXTENSION), os.path.join(output, item)))
+    return [ triple for triple in triples if os.path.isfile(triple[1]) ]
+
+def main(args):
+    for old_path, other_path, output_path in paired_paths(args):
+        old = Node.lazy_from_file(old_path) #Parts equal in both files are compared as text and never parsed
+        if old is None:
+            print('Cannot load', old_path)
+            continue
+
+        if args.new:
+            new = Node.lazy_from_file(other_path)
+            if new is None:
+                print('Cannot load', other_path)
+                continue
+            patch = old.diff(new)
+            changed = patch is not None
+            if not changed: patch = NodePatch({}, {}, None)
+            patch.base_hash = NodePatch.text_hash(old_path) #Applying to another version of the file is refused
+            patch.write(output_path)
+            print(old_path, '+', other_path, '->', output_path, '' if changed else '(no changes)')
+        else:
+            try:
+                patch = NodePatch.from_file(other_path)
+                if patch.base_hash is not None and patch.base_hash != NodePatch.text_hash(old_path):
+                    raise ValueError(f'it was made for another version of {old_path}')
+                old.apply_patch(patch)
+            except ValueError as e:
+                print('Cannot apply', other_path + ':', e)
+                continue
+            old.write(output_path)
+            print(old_path, '+', other_path, '->', output_path)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
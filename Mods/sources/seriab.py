@@ -0,0 +1,41 @@
+import argparse
+import os
+from utils.parsing import *
+
+parser = argparse.ArgumentParser(description='A .seria <-> .seriab converter. .seria files are compiled into the binary .seriab, .seriab files are converted back to text.')
+
+parser.add_argument('--paths', type=str, nargs='+',
+                    help='files or directories to convert.')
+parser.add_argument('--output', type=str,
+                    help='output directory, next to the input files if not set.', default=None)
+
+def converted_path(path, output_dir):
+    if path.endswith(SERIAB_EXTENSION):
+        name = os.path.basename(path)[:-len(SERIAB_EXTENSION)] + '.seria'
+    else:
+        name = os.path.basename(path) + SERIAB_EXTENSION[len('.seria'):]
+    return os.path.join(output_dir if output_dir else os.path.dirname(path), name)
+
+def main(args):
+    paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            paths += [ os.path.join(path, item) for item in sorted(os.listdir(path)) if item.endswith(('.seria', SERIAB_EXTENSION)) ]
+        else:
+            paths.append(path)
+
+    if args.output: os.makedirs(args.output, exist_ok=True)
+
+    for path in paths:
+        node = Node.from_file(path)
+        if node is None:
+            print('Cannot convert', path)
+            continue
+
+        output_path = converted_path(path, args.output)
+        node.write(output_path)
+        print(path, '->', output_path)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -11,11 +11,11 @@ STRIKE_GROUPS = {
     ShipEntry([ 'Gryphon', 'Borey', 'Kormoran', 'Negev' ]),
     ShipEntry(['Tarantul ARM'], ['hard']),
 ],
-0			: {
+0			: [
     ShipEntry([ 'Gryphon' ]),
     ShipEntry([ 'Gryphon', 'Borey', 'Kormoran', 'Negev' ]),
     ShipEntry(['Tarantul ARM'], ['hard']),
-},
+],
 1			: [
     ShipEntry([ 'Gryphon' ]),
     ShipEntry([ 'Gryphon', 'Borey', 'Kormoran', 'Negev' ]),
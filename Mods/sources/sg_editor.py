@@ -2,15 +2,19 @@ import argparse
 import os
 import copy
 import importlib
-import random
+import io
+import glob
+import zlib
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 from utils.parsing import *
 
 parser = argparse.ArgumentParser(description='A SG save editor.')
 
 parser.add_argument('--save', type=str,
-                    help='save file location to tweak.')
+                    help='save file location to tweak. A directory or a glob pattern of saves runs in the batch mode.')
 parser.add_argument('--output', type=str,
-                    help='output path for a new save.', default='Saves_updated/profile.seria')
+                    help='output path for a new save, Saves_updated/profile.seria if not set. In the batch mode a directory mirroring the input tree, Saves_updated if not set.', default=None)
 parser.add_argument('--config', type=str,
                     help='a .py file contatining SG configs', default='sg_config')
 parser.add_argument('--vanilla', type=str,
@@ -19,16 +23,30 @@ parser.add_argument('--custom', type=str,
                     help='Highfleet/Ships path', default='../Ships')
 parser.add_argument('--verbose', action='store_true',
                     help='verbose output',  default=False)
+parser.add_argument('--seed', type=int,
+                    help='random seed, the same save, config and seed give the same output. Random if not set.', default=None)
+parser.add_argument('--jobs', type=int,
+                    help='number of worker processes editing saves in parallel in the batch mode.', default=os.cpu_count())
                     
 
-def sample_fleet_from_entries(sg_entry, difficulty):
-    entries = [ random.choice(x.names) for x in sg_entry ] #Sample a random ship from several choices
-    entries = [ ship for ship, entry in zip(entries, sg_entry) if (random.random() < entry.spawn_chance) and difficulty in entry.difficulties ] #Filter by difficulty/spawn rate
+def sample_fleet_from_entries(sg_entry, difficulty, rng):
+    entries = [ x.names[rng.integers(len(x.names))] for x in sg_entry ] #Sample a random ship from several choices
+    entries = [ ship for ship, entry in zip(entries, sg_entry) if (rng.random() < entry.spawn_chance) and difficulty in entry.difficulties ] #Filter by difficulty/spawn rate
     return entries
     
-def update_escadra(args, escadra, index, difficulty_level, ship_cache, config):
+def load_ship_template(path):
+    '''Returns the compacted template of a design, cached on disk in a .sg_templates dir next to the design file'''
+    cache = TemplateCache(os.path.join(os.path.dirname(path), '.sg_templates'))
+    template = cache.load(path, Ship)
+    if template is None:
+        stat = os.stat(path)
+        template = compact_ship_template(Ship.lazy_from_file(path)) #Parses only the parts kept in the template
+        cache.store(path, Ship, template, stat)
+    return template
+    
+def update_escadra(args, escadra, index, difficulty_level, ship_cache, config, rng, allocator):
     fleet_comp = config.STRIKE_GROUPS[index]
-    fleet_comp = sample_fleet_from_entries(fleet_comp, difficulty_level)
+    fleet_comp = sample_fleet_from_entries(fleet_comp, difficulty_level, rng)
     
     if args.verbose: print(f'Escadra {escadra.m_name}, sampled new fleet composition: {fleet_comp}')
     
@@ -38,31 +56,34 @@ def update_escadra(args, escadra, index, difficulty_level, ship_cache, config):
         if item in ship_cache.keys():
             ship = ship_cache[item]
         else:
-            try:    ship = Ship.from_file(os.path.join(args.vanilla, item + '.seria'))
-            except: ship = Ship.from_file(os.path.join(args.custom,  item + '.seria'))
+            try:    ship = load_ship_template(os.path.join(args.vanilla, item + '.seria'))
+            except: ship = load_ship_template(os.path.join(args.custom,  item + '.seria'))
             ship_cache[item] = ship
         ships.append(ship)
     
-    replace_escadra_ships(escadra, ships)
+    replace_escadra_ships(escadra, ships, rng, allocator)
     
     
-def main(args):
-    config_path = args.config
+def load_config(config_path):
     if config_path.endswith('.py'):
         config_path = config_path[:-3]
-    
-    config = importlib.import_module(config_path)
-    if args.verbose: print('Loaded config')
+    return importlib.import_module(config_path)
+
+def edit_save(args, config, save_path, output_path, seed, ship_cache):
+    '''Rerolls strike and launcher groups of a single save. ship_cache keeps ship templates between calls.'''
     if args.verbose: print('Loading save...')
     
-    save = Node.from_file(args.save)
+    #All random values of a run come from one Generator, so a fixed --seed reproduces the output byte by byte
+    rng = np.random.default_rng(seed)
+    allocator = IdAllocator(rng)
+    
+    save = Node.from_file(save_path)
+    allocator.reserve_tree(save) #New ships never reuse IDs already in the save
     escadras = save.get_children_by_name('m_escadras')
     strike_groups = []
     carrier_groups= []
     launcher_groups= []
     
-    ship_cache = {}
-    
     for escadra in escadras: #Find SGs and carrier groups
         children = escadra.get_children_by_name('m_children')
         is_sg = False
@@ -123,13 +144,70 @@ def main(args):
         index = 'endgame' if endgame and (6 not in config.STRIKE_GROUPS.keys()) else index
         index = index if index in config.STRIKE_GROUPS.keys() else 'default'
         
-        update_escadra(args, escadra, index, difficulty_level, ship_cache, config)
+        update_escadra(args, escadra, index, difficulty_level, ship_cache, config, rng, allocator)
     
     for i, escadra in enumerate(launcher_groups):
         index = 'launcher'
-        update_escadra(args, escadra, index, difficulty_level, ship_cache, config)
+        update_escadra(args, escadra, index, difficulty_level, ship_cache, config, rng, allocator)
     
-    save.write(args.output)
+    save.write(output_path)
+
+#(args, config, ship_cache) of a batch worker, the config and templates stay loaded between saves
+worker_state = None
+
+def init_worker(args):
+    global worker_state
+    worker_state = (args, load_config(args.config), {})
+
+def edit_save_in_worker(save_path, output_path, seed):
+    '''Edits a save with the worker state, returns the log text so logs of parallel workers can be printed in order'''
+    args, config, ship_cache = worker_state
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        print(save_path)
+        try:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            edit_save(args, config, save_path, output_path, seed, ship_cache)
+        except Exception as e:
+            print('Cannot update save:', e)
+        print()
+    return log.getvalue()
+
+def find_saves(pattern):
+    '''Returns (root, save paths) of a directory or a glob pattern, outputs mirror the tree under root'''
+    if os.path.isdir(pattern):
+        paths = glob.glob(os.path.join(glob.escape(pattern), '**', '*.seria'), recursive=True)
+        paths+= glob.glob(os.path.join(glob.escape(pattern), '**', '*' + SERIAB_EXTENSION), recursive=True)
+        return pattern, sorted(paths)
+    paths = sorted([ path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path) ])
+    root = os.path.commonpath([ os.path.dirname(os.path.abspath(path)) for path in paths ]) if paths else '.'
+    return root, paths
+
+def main(args):
+    if os.path.isfile(args.save):
+        config = load_config(args.config)
+        if args.verbose: print('Loaded config')
+        edit_save(args, config, args.save, args.output or 'Saves_updated/profile.seria', args.seed, {})
+        return
+    
+    root, save_paths = find_saves(args.save)
+    if not save_paths:
+        print('No saves found:', args.save)
+        return
+    
+    rel_paths = [ os.path.relpath(os.path.abspath(path), os.path.abspath(root)) for path in save_paths ]
+    output_paths = [ os.path.join(args.output or 'Saves_updated', path) for path in rel_paths ]
+    #Each save gets its own seed derived from its relative path, so results don't depend on the worker scheduling
+    seeds = [ None if args.seed is None else [ args.seed, zlib.crc32(path.encode('utf-8')) ] for path in rel_paths ]
+    
+    if args.jobs is None or args.jobs <= 1:
+        init_worker(args)
+        for log in map(edit_save_in_worker, save_paths, output_paths, seeds):
+            print(log, end='')
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=(args,)) as pool:
+            for log in pool.map(edit_save_in_worker, save_paths, output_paths, seeds):
+                print(log, end='')
     
 if __name__ == "__main__":
     args = parser.parse_args()
@@ -0,0 +1,145 @@
+import argparse
+import os
+import pickle
+import shutil
+from utils.parsing import *
+
+parser = argparse.ArgumentParser(description='A submod installer. Builds Designs with the enabled submods over the base designs, files are hardlinked (or copied) instead of being parsed and written again.')
+
+parser.add_argument('--submods', type=str,
+                    help='Mods/Submods path', default='../Mods/Submods')
+parser.add_argument('--base', type=str,
+                    help='Highfleet/Objects/Designs path with the designs to install the submods over', default='../Objects/Designs')
+parser.add_argument('--output', type=str,
+                    help='a directory where to build the installed designs, must not be --base. Rerunning with other submods only updates the changed files.', default='Designs_installed')
+parser.add_argument('--enable', type=str, nargs='*',
+                    help='submods to enable, a later one overrides an earlier one. A submod is a Submods folder with files ("MG Ships") or its subfolder ("SG Ships/Borey" or "Borey"), a folder name enables all its subfolders ("SG Ships").', default=[])
+parser.add_argument('--copy', action='store_true',
+                    help='copy the files instead of hardlinking them. Hardlinked files are shared with the sources, so do not edit them in place.', default=False)
+parser.add_argument('--list', action='store_true',
+                    help='only print the submods and the files the enabled ones would override.', default=False)
+
+SUBMOD_EXTENSIONS = ('.seria', SERIAB_EXTENSION, '.png')
+
+def index_submods(root):
+    '''Returns { submod name: { file name: path } } of all submods under root. Each folder with .seria/.png files is
+    a submod named by its path relative to root, e.g. "MG Ships" or "SG Ships/Borey".'''
+    submods = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        files = { name: os.path.join(dirpath, name) for name in sorted(filenames) if name.endswith(SUBMOD_EXTENSIONS) }
+        if files and dirpath != root:
+            submods[os.path.relpath(dirpath, root).replace(os.sep, '/')] = files
+    return submods
+
+def select_submods(submods, names):
+    '''Returns the submods matching the names in their order and the names matching nothing'''
+    selected, unknown = [], []
+    for name in names:
+        name = name.strip('/\\').replace(os.sep, '/')
+        matches = [ submod for submod in submods if submod == name or submod.startswith(name + '/') ]
+        matches = matches or [ submod for submod in submods if submod.rsplit('/', 1)[-1] == name ]
+        if not matches: unknown.append(name)
+        selected += [ submod for submod in matches if submod not in selected ]
+    return selected, unknown
+
+def build_plan(base, submods, selected):
+    '''Returns the merge plan { file name: source path } of the whole install, { file name: submods with it } and the
+    conflicts as (file name, overridden submods, used submod). Submods override the base files and the earlier submods.'''
+    plan = { name: os.path.abspath(os.path.join(base, name)) for name in sorted(os.listdir(base)) if os.path.isfile(os.path.join(base, name)) }
+    owners = {}
+    for submod in selected:
+        for name, path in submods[submod].items():
+            plan[name] = os.path.abspath(path)
+            owners.setdefault(name, []).append(submod)
+    conflicts = [ (name, owner[:-1], owner[-1]) for name, owner in sorted(owners.items()) if len(owner) > 1 ]
+    return plan, owners, conflicts
+
+def is_installed(source, target, link):
+    '''True if target is a hardlink of source, or a copy of it if not linking'''
+    try:
+        target_stat = os.stat(target)
+    except FileNotFoundError:
+        return False
+    source_stat = os.stat(source)
+    if os.path.samestat(source_stat, target_stat): return link
+    return (source_stat.st_size, source_stat.st_mtime_ns) == (target_stat.st_size, target_stat.st_mtime_ns)
+
+def copy_file(source, target):
+    '''Copies in the kernel with copy_file_range if possible. The mtime is kept, so is_installed skips the copy next time.'''
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        try:
+            if not hasattr(os, 'copy_file_range'): raise OSError()
+            while os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30): pass
+        except OSError: #Not supported here, copy the rest in the user space
+            shutil.copyfileobj(src, dst)
+    shutil.copystat(source, target)
+
+def install_file(source, target, link):
+    '''Replaces target with a hardlink or a copy of source, returns if it was linked'''
+    tmp_path = f'{target}.{os.getpid()}.tmp'
+    try:
+        if link:
+            try:
+                os.link(source, tmp_path)
+            except OSError: #Another drive or no hardlinks on the file system
+                link = False
+        if not link: copy_file(source, tmp_path)
+        os.replace(tmp_path, target)
+    except:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+    return link
+
+def main(args):
+    submods = index_submods(args.submods)
+    selected, unknown = select_submods(submods, args.enable)
+    for name in unknown: print('Unknown submod:', name)
+
+    plan, owners, conflicts = build_plan(args.base, submods, selected)
+    for name, overridden, used in conflicts:
+        print(f'Conflict: {name} is in {", ".join(overridden + [ used ])}, using {used}')
+
+    if args.list:
+        for submod, files in submods.items():
+            print(('[x] ' if submod in selected else '[ ] ') + submod)
+            for name in files:
+                used = owners.get(name, [ submod ])[-1]
+                print('    ' + name + ('' if used == submod else f' (overridden by {used})'))
+        return
+
+    if os.path.abspath(args.output) == os.path.abspath(args.base):
+        print('--output cannot be --base, base files are the sources of the install')
+        return
+
+    os.makedirs(args.output, exist_ok=True)
+    state_path = os.path.join(args.output, '.install_state.pickle')
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, 'rb') as f:
+            state = pickle.load(f)
+
+    #Files installed before and left out now, other files in the output are not touched
+    removed = 0
+    for name in state.keys() - plan.keys():
+        path = os.path.join(args.output, name)
+        if os.path.exists(path):
+            os.remove(path)
+            removed += 1
+
+    link = not args.copy
+    updated = 0
+    for name, source in plan.items():
+        target = os.path.join(args.output, name)
+        if state.get(name) == source and is_installed(source, target, link): continue
+        link = install_file(source, target, link)
+        updated += 1
+
+    with open(state_path, 'wb') as f:
+        pickle.dump(plan, f)
+
+    print(f'Installed {", ".join(selected) if selected else "no submods"} into {args.output}: {updated} files updated, {removed} removed ({"hardlinks" if link else "copies"})')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -1,12 +1,17 @@
 import argparse
 import os
+import io
+import contextlib
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from utils.parsing import *
 import shutil
 
 parser = argparse.ArgumentParser(description='A ship .seria updater.')
 
 parser.add_argument('--dir', type=str,
-                    help='a directory with .seria files to update', default='../Objects/Designs')
+                    help='a directory with .seria (or binary .seriab) files to update', default='../Objects/Designs')
 parser.add_argument('--out', type=str,
                     help='a directory where to output updated files.', default='Ships_updated')
 parser.add_argument('--OL', type=str,
@@ -15,9 +20,61 @@ parser.add_argument('--parts', type=str,
                     help='path to the parts.seria', default='../Libraries/parts.seria')
 parser.add_argument('--vOL', type=str,
                     help='path to the vanilla .OL. "Vanilla" means the original OL used during the ship construction.', default='../Backups/Libraries/OL.seria')
+parser.add_argument('--jobs', type=int,
+                    help='number of worker processes updating ships in parallel.', default=os.cpu_count())
+parser.add_argument('--incremental', action='store_true',
+                    help='only update ships which use OL/parts entries changed since the previous run into the same --out dir, or were changed themselves.', default=False)
 
-                    
-args = parser.parse_args()
+#(ol, vanilla_ol, parts) parsed once in the main process and sent to each worker on its start
+libraries = None
+
+def init_worker(ol, vanilla_ol, parts):
+    global libraries
+    libraries = (ol, vanilla_ol, parts)
+
+def used_oids(ship):
+    return { child.m_oid for child in ship.find_by_attr('m_oid') if not isinstance(child.m_oid, list) }
+
+def update_ship(ship_name, out_path):
+    '''Updates a single ship file. Returns its log text, so logs of parallel workers can be printed in order,
+    and the set of module OIDs the ship uses, or None if it could not be updated.'''
+    ol, vanilla_ol, parts = libraries
+    
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        print(os.path.basename(ship_name))
+        ship = Ship.from_file(ship_name)
+        try:
+            oids = used_oids(ship) #Inside the try, ship is None if the file cannot be parsed
+            ship.recompute_stats(ol, vanilla_ol, parts, verbose=True)
+            ship.write(out_path)
+        except:
+            try:
+                print('Cannot update global stats, recomputing local only')
+                ship = Ship.from_file(ship_name)
+                oids = used_oids(ship)
+                ship.update_modules(parts, ol, vanilla_ol)
+                ship.write(out_path)
+            except:
+                print('Cannot update')
+                print('---------------------------')
+                oids = None
+        print()
+    return log.getvalue(), oids
+
+def library_fingerprints(library):
+    '''Maps each m_oid of a library to a hash of its entries' text'''
+    fingerprints = {}
+    for entry in library.find_by_attr('m_oid'):
+        if isinstance(entry.m_oid, list): continue
+        digest = fingerprints.setdefault(entry.m_oid, hashlib.sha1())
+        digest.update(entry.output().encode('utf-8'))
+    return { oid: digest.hexdigest() for oid, digest in fingerprints.items() }
+
+def changed_oids(old_fingerprints, new_fingerprints):
+    '''OIDs added, removed or changed between two library_fingerprints results'''
+    oids = set(old_fingerprints.keys()) | set(new_fingerprints.keys())
+    return { oid for oid in oids if old_fingerprints.get(oid) != new_fingerprints.get(oid) }
 
 def main(args):
     ol = OL.from_file(args.OL)
@@ -26,30 +83,69 @@ def main(args):
     
     output_ships_path = args.out
     
+    #The state of the previous run: library fingerprints and source hash + used OIDs of every updated ship
+    state_path = os.path.join(output_ships_path, '.update_state.pickle')
+    state = { 'libraries': {}, 'ships': {} }
+    if args.incremental and os.path.exists(state_path):
+        with open(state_path, 'rb') as f:
+            state = pickle.load(f)
+    
+    fingerprints = { 'OL': library_fingerprints(ol), 'vOL': library_fingerprints(vanilla_ol), 'parts': library_fingerprints(parts) }
+    changed = set()
+    for name, new_fingerprints in fingerprints.items():
+        changed |= changed_oids(state['libraries'].get(name, {}), new_fingerprints)
+    
+    #Reverse index OID -> ships which use it
+    users = {}
+    for ship, ship_state in state['ships'].items():
+        for oid in ship_state['oids']:
+            users.setdefault(oid, set()).add(ship)
+    affected = set()
+    for oid in changed:
+        affected |= users.get(oid, set())
+    
+    ship_names, out_paths, ship_hashes = [], [], []
+    ships_state = {}
     for ship in os.listdir(args.dir):
-        if ship.endswith('.seria'):
-            print(ship)
-            out_path = os.path.join(output_ships_path, ship)
+        if ship.endswith(('.seria', SERIAB_EXTENSION)):
             ship_name = os.path.join(args.dir, ship)
-            ship = Ship.from_file(ship_name)
-            try:
-                ship.recompute_stats(ol, vanilla_ol, parts, verbose=True)
-                ship.write(out_path)
-            except:
-                try:
-                    print('Cannot update global stats, recomputing local only')
-                    ship = Ship.from_file(ship_name)
-                    ship.update_modules(parts, ol, vanilla_ol)
-                    ship.write(out_path)
-                except:
-                    print('Cannot update')
-                    print('---------------------------')
-            print()
+            out_path  = os.path.join(output_ships_path, ship)
+            ship_hash = ParseCache.file_hash(ship_name)
+            ship_state = state['ships'].get(ship)
+            
+            if (args.incremental and ship not in affected and ship_state is not None and
+                ship_state['hash'] == ship_hash and os.path.exists(out_path)):
+                ships_state[ship] = ship_state #Up to date, keep the previous output
+                continue
+            
+            ship_names.append(ship_name)
+            out_paths.append(out_path)
+            ship_hashes.append(ship_hash)
         elif ship.endswith('.png'):
             dst = os.path.join(output_ships_path, ship)
             src = os.path.join(args.dir, ship)
             shutil.copyfile(src, dst)
+    
+    if args.incremental:
+        print(f'{len(changed)} library entries changed, updating {len(ship_names)} ships, {len(ships_state)} are up to date')
+        print()
+    
+    def record(results):
+        for ship_name, ship_hash, (log, oids) in zip(ship_names, ship_hashes, results):
+            print(log, end='')
+            if oids is not None:
+                ships_state[os.path.basename(ship_name)] = { 'hash': ship_hash, 'oids': oids }
+    
+    if args.jobs is None or args.jobs <= 1:
+        init_worker(ol, vanilla_ol, parts)
+        record(map(update_ship, ship_names, out_paths))
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=(ol, vanilla_ol, parts)) as pool:
+            record(pool.map(update_ship, ship_names, out_paths))
+    
+    with open(state_path, 'wb') as f:
+        pickle.dump({ 'libraries': fingerprints, 'ships': ships_state }, f)
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)